@@ -7,12 +7,14 @@ from musik import config
 from musik import log
 import musik.audiotranscode
 import musik.importer
+import musik.importer.watcher
+import musik.transcoding
 import musik.web
 
 
 # cleans up and safely stops the application
 def cleanup(signum=None, frame=None):
-    global log, importThread, app
+    global log, importThread, watchThread, pretranscodeThread, app
 
     if type(signum) == type(None):
         pass
@@ -25,6 +27,16 @@ def cleanup(signum=None, frame=None):
         importThread.join(5)
         if importThread.isAlive():
             log.error(u'Failed to clean up importThread')
+    if watchThread != None:
+        watchThread.stop()
+        watchThread.join(5)
+        if watchThread.isAlive():
+            log.error(u'Failed to clean up watchThread')
+    if pretranscodeThread != None:
+        pretranscodeThread.stop()
+        pretranscodeThread.join(5)
+        if pretranscodeThread.isAlive():
+            log.error(u'Failed to clean up pretranscodeThread')
 
     log.info(u'Stopping CherryPy Engine')
     app.stop()
@@ -35,7 +47,7 @@ def cleanup(signum=None, frame=None):
 
 # application entry - starts the database connection and dev server
 if __name__ == '__main__':
-    global log, importThread, app
+    global log, importThread, watchThread, pretranscodeThread, app
 
     threads = []
 
@@ -52,7 +64,21 @@ if __name__ == '__main__':
     importThread.start()
     threads.append(importThread)
 
-    # query audiotranscode for available codecs
+    # optionally watch the library directories for changes
+    watchThread = None
+    if config.get('Watcher', 'enabled') == 'true':
+        watchThread = musik.importer.watcher.WatchThread()
+        watchThread.start()
+        threads.append(watchThread)
+
+    # optionally transcode popular tracks ahead of time
+    pretranscodeThread = None
+    if config.get('Pretranscode', 'enabled') == 'true':
+        pretranscodeThread = musik.transcoding.PretranscodeThread()
+        pretranscodeThread.start()
+        threads.append(pretranscodeThread)
+
+    # query audiotranscode for available codecs. They are only looked for once per process
     transcode = musik.audiotranscode.AudioTranscode()
     row_format = "{:>10}" * 3
     log.info(u'Supported Encoders:')
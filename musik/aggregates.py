@@ -0,0 +1,43 @@
+"""Denormalized counts and lengths of the albums and artists in the library.
+Albums store the number and total length of their tracks, and artists store the number of their
+albums and the number and total length of the tracks on those albums, so that lists can be
+serialized, sorted and filtered without reading the tracks table. The importer updates the
+albums and artists of the tracks that it imports in the same transaction as the tracks
+themselves, and repair recomputes every row, e.g. after the database was changed by hand.
+Missing tracks are counted along with the rest, because they still belong to their albums.
+"""
+
+from musik.util import uri_chunks
+
+from sqlalchemy.sql import text
+
+
+ALBUM_TOTALS = '''
+    UPDATE albums SET
+        track_count = (SELECT count(*) FROM tracks WHERE tracks.album_id = albums.id),
+        length = (SELECT coalesce(sum(tracks.length), 0) FROM tracks WHERE tracks.album_id = albums.id)
+'''
+
+# artist totals are summed from the album totals, so albums have to be updated first
+ARTIST_TOTALS = '''
+    UPDATE artists SET
+        album_count = (SELECT count(*) FROM albums WHERE albums.artist_id = artists.id),
+        track_count = (SELECT coalesce(sum(albums.track_count), 0) FROM albums WHERE albums.artist_id = artists.id),
+        length = (SELECT coalesce(sum(albums.length), 0) FROM albums WHERE albums.artist_id = artists.id)
+'''
+
+
+def update_tracks(connection, uris):
+    """Recomputes the totals of the albums and artists of the tracks at the specified uris.
+    This should be called with the connection of the session that changed the tracks, after it
+    has been flushed, so that the totals are committed along with them."""
+    for (selected, params) in uri_chunks(uris):
+        connection.execute(text('%s WHERE albums.id IN (SELECT tracks.album_id FROM tracks WHERE %s)' % (ALBUM_TOTALS, selected)), **params)
+        connection.execute(text('%s WHERE artists.id IN (SELECT albums.artist_id FROM albums JOIN tracks ON tracks.album_id = albums.id WHERE %s)'
+                                % (ARTIST_TOTALS, selected)), **params)
+
+
+def repair(connection):
+    """Recomputes the totals of every album and artist in the library"""
+    connection.execute(text(ALBUM_TOTALS))
+    connection.execute(text(ARTIST_TOTALS))
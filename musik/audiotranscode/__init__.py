@@ -27,9 +27,12 @@ __version__ = '0.2'
 import subprocess
 import re
 import os
-import time
+import select
+import threading
 from distutils.spawn import find_executable
 
+from musik.audiotranscode import pcm
+
 MIMETYPES = {
     'mp3': 'audio/mpeg',
     'ogg': 'audio/ogg',
@@ -39,6 +42,21 @@ MIMETYPES = {
     'wav': 'audio/wav',
 }
 
+# bitrates in kbps that formats are encoded at unless another bitrate is specified
+BITRATES = {'mp3': 160, 'ogg': 128, 'aac': 128}
+DEFAULT_BITRATE = 128
+
+# the bitrates in kbps that a stream can be encoded at. Other bitrates are
+# rounded down to one of these, so that there are only a few versions of
+# each track in the transcode cache.
+BITRATE_STEPS = [64, 96, 128, 160, 192, 256, 320]
+
+# quality profiles that can be asked for instead of a bitrate
+QUALITIES = {'low': 96, 'medium': 128, 'high': 192}
+
+# formats whose encoders don't take a bitrate
+LOSSLESS = ['flac', 'wav']
+
 
 class Transcoder(object):
     """super class for encoders and decoders"""
@@ -46,11 +64,26 @@ class Transcoder(object):
 
     def __init__(self):
         self.command = ['']
+        self.path = None        # absolute path of the command
+        self.installed = None   # None until the command has been looked for
+
+    def probe(self):
+        """looks for the command on the PATH and remembers where it is.
+        returns True if it was found"""
+        self.path = find_executable(self.command[0])
+        return bool(self.path)
 
     def available(self):
         """checks if the command defined in the encoder or decoder is
-        available by calling it once"""
-        return bool(find_executable(self.command[0]))
+        available. The PATH is only searched the first time, see refresh"""
+        if self.installed is None:
+            self.installed = self.probe()
+        return self.installed
+
+    def executable(self):
+        """returns the absolute path under which the command is found"""
+        self.available()
+        return self.path
 
 
 class Encoder(Transcoder):
@@ -63,15 +96,22 @@ class Encoder(Transcoder):
 
     def encode(self, decoder_process, bitrate):
         """encodes the raw audio stream coming from the decoder_process
-        using the spedcified command"""
-        # get the absolute path under which the executable is found
-        cmd = [find_executable(self.command[0])] + self.command[1:]
+        using the spedcified command. If the decoder runs in-process, the
+        stream has to be written to the encoder's stdin."""
+        cmd = [self.executable()] + self.command[1:]
         if 'BITRATE' in cmd:
             cmd[cmd.index('BITRATE')] = str(bitrate)
+        if isinstance(decoder_process, subprocess.Popen):
+            stdin = decoder_process.stdout
+        else:
+            stdin = subprocess.PIPE
+        # close_fds keeps the pipes of other streams that are starting at
+        # the same time from leaking into this process and holding them open
         return subprocess.Popen(cmd,
-                                stdin=decoder_process.stdout,
+                                stdin=stdin,
                                 stdout=subprocess.PIPE,
-                                stderr=Transcoder.devnull
+                                stderr=Transcoder.devnull,
+                                close_fds=True
                                 )
 
     def __str__(self):
@@ -92,13 +132,13 @@ class Decoder(Transcoder):
 
     def decode(self, filepath):
         """returns the process the decodes the file to a raw audio stream"""
-        # get the absolute path under which the executable is found
-        cmd = [find_executable(self.command[0])] + self.command[1:]
+        cmd = [self.executable()] + self.command[1:]
         if 'INPUT' in cmd:
             cmd[cmd.index('INPUT')] = filepath
         return subprocess.Popen(cmd,
                                 stdout=subprocess.PIPE,
-                                stderr=Transcoder.devnull
+                                stderr=Transcoder.devnull,
+                                close_fds=True
                                 )
 
     def __str__(self):
@@ -109,6 +149,52 @@ class Decoder(Transcoder):
         return self.__str__()
 
 
+class PythonEncoder(Encoder):
+    """encoder that runs in-process. function is called with an iterable of
+    the chunks of the decoded stream and the bitrate, and returns an
+    iterable of the chunks of the encoded stream."""
+    def __init__(self, filetype, function):
+        Encoder.__init__(self, filetype, ['python'])
+        self.function = function
+
+    def probe(self):
+        return True
+
+    def encode(self, decoder_process, bitrate):
+        """returns a generator of the encoded stream"""
+        if isinstance(decoder_process, subprocess.Popen):
+            decoder_process = read_output(decoder_process.stdout)
+        return self.function(decoder_process, bitrate)
+
+    def __str__(self):
+        return "<PythonEncoder type='%s' function='%s'>" % (
+            self.filetype, self.function.__name__)
+
+
+class PythonDecoder(Decoder):
+    """decoder that runs in-process. function is called with the path of
+    the file, and returns an iterable of the chunks of the decoded stream.
+    It raises pcm.FormatError if it can't handle the file, in which case
+    the next decoder for the file type is tried."""
+    def __init__(self, filetype, function):
+        Decoder.__init__(self, filetype, ['python'])
+        self.function = function
+
+    def probe(self):
+        return True
+
+    def decode(self, filepath):
+        """returns a generator of the decoded stream"""
+        try:
+            return self.function(filepath)
+        except pcm.FormatError as exc:
+            raise DecodeError(exc.value)
+
+    def __str__(self):
+        return "<PythonDecoder type='%s' function='%s'>" % (
+            self.filetype, self.function.__name__)
+
+
 class TranscodeError(Exception):
     """exception for if either a decoder or encoder error has occurred"""
     def __init__(self, value):
@@ -150,11 +236,83 @@ def mime_type(file_extension):
     return MIMETYPES.get(file_extension)
 
 
+def passthrough(chunks, bitrate):
+    """an encoder function that leaves the decoded stream as it is"""
+    return chunks
+
+
+def read_output(pipe, min_size=4096, max_size=65536, timeout=60):
+    """returns a generator of the data that a process writes to pipe. The
+    data is read in chunks of min_size to max_size bytes. Reads grow while
+    the process keeps filling them and shrink when it doesn't, so that a
+    fast process is read with few system calls and a slow one doesn't
+    allocate a large buffer for every few bytes. Raises TranscodeError if
+    nothing is written for timeout seconds."""
+    fileno = pipe.fileno()
+    size = min_size
+    while True:
+        # os.read returns as soon as any output is available, where
+        # file.read would wait until the whole chunk was filled
+        if not select.select([fileno], [], [], timeout)[0]:
+            raise TranscodeError('No output for %d seconds' % timeout)
+        data = os.read(fileno, size)
+        if not data:
+            return  # the process closed its output
+        if len(data) == size:
+            size = min(size * 2, max_size)
+        elif len(data) < size // 4:
+            size = max(size // 2, min_size)
+        yield data
+
+
+class _Feeder(threading.Thread):
+    """writes the stream of an in-process decoder to the stdin of an
+    encoder process"""
+    def __init__(self, chunks, pipe):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.chunks = chunks
+        self.pipe = pipe
+        self.error = None   # the exception that the decoder failed with
+
+    def run(self):
+        try:
+            for data in self.chunks:
+                self.pipe.write(data)
+        except IOError:
+            pass  # the encoder went away, which transcode_stream notices
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.pipe.close()
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+
+
+def default_bitrate(audio_format):
+    """return the bitrate that an audio format is encoded at by default"""
+    return BITRATES.get(audio_format, DEFAULT_BITRATE)
+
+
+def bitrate_step(bitrate):
+    """return the highest of the BITRATE_STEPS that isn't higher than
+    bitrate, or the lowest of them"""
+    steps = [step for step in BITRATE_STEPS if step <= bitrate]
+    return steps[-1] if steps else BITRATE_STEPS[0]
+
+
 class AudioTranscode:
     """main class that manages encoders and decoders
     call transcode(infile, outfile) for file transformations
     or transcode_stream to get a generator of the encoded stream"""
-    READ_BUFFER = 1024
+    # the encoder's output is read in chunks of MIN_READ_BUFFER to READ_BUFFER
+    # bytes. See read_output.
+    READ_BUFFER = 65536
+    MIN_READ_BUFFER = 4096
+    # seconds that the encoder may go without any output before it is killed
+    STALL_TIMEOUT = 60
+    # encoders and decoders are tried in order, so in-process ones come
+    # before the commands that do the same job
     Encoders = [
         #encoders take input from stdin and write output to stout
         Encoder('ogg', ['oggenc', '-b', 'BITRATE', '-']),
@@ -167,6 +325,7 @@ class AudioTranscode:
         Encoder('flac', ['flac', '--force-raw-format', '--endian=little',
                          '--channels=2', '--bps=16', '--sample-rate=44100',
                          '--sign=signed', '-o', '-', '-']),
+        PythonEncoder('wav', passthrough),
         Encoder('wav', ['cat']),
     ]
     Decoders = [
@@ -180,16 +339,23 @@ class AudioTranscode:
         Decoder('flac', ['flac', '-F', '-d', '-c', 'INPUT']),
         Decoder('aac', ['faad', '-w', 'INPUT']),
         Decoder('m4a', ['faad', '-w', 'INPUT']),
+        PythonDecoder('wav', pcm.decode_wav),
         Decoder('wav', ['cat', 'INPUT']),
     ]
 
     def __init__(self, debug=False):
         self.debug = debug
-        self.available_encoders = [enc for enc in AudioTranscode.Encoders
-                                   if enc.available()]
-        self.available_decoders = [dec for dec in AudioTranscode.Decoders
-                                   if dec.available()]
-        self.bitrate = {'mp3': 160, 'ogg': 128, 'aac': 128}
+        self.bitrate = dict(BITRATES)
+
+    @property
+    def available_encoders(self):
+        """the encoders whose commands are installed"""
+        return [enc for enc in AudioTranscode.Encoders if enc.available()]
+
+    @property
+    def available_decoders(self):
+        """the decoders whose commands are installed"""
+        return [dec for dec in AudioTranscode.Decoders if dec.available()]
 
     def available_encoder_formats(self):
         """returns the names of all available encoder formats"""
@@ -200,7 +366,8 @@ class AudioTranscode:
         return set(dec.filetype for dec in self.available_decoders)
 
     def _decode(self, filepath, decoder=None):
-        """find the correct decoder and return a decoder process"""
+        """find the correct decoder and return a decoder process, or the
+        generator of an in-process decoder"""
         if not os.path.exists(filepath):
             filepath = os.path.abspath(filepath)
             errmsg = 'File not Found! Cannot decode "file" %s'
@@ -210,22 +377,29 @@ class AudioTranscode:
             errmsg = 'No decoder available to handle filetype %s'
             raise DecodeError(errmsg % filetype)
         elif not decoder:
-            for dec in self.available_decoders:
-                if dec.filetype == filetype:
-                    decoder = dec
-                    break
-            if self.debug:
-                print(decoder)
+            decoders = [dec for dec in self.available_decoders
+                        if dec.filetype == filetype]
+            for dec in decoders:
+                if self.debug:
+                    print(dec)
+                try:
+                    return dec.decode(filepath)
+                except DecodeError:
+                    # an in-process decoder can't handle this particular
+                    # file, so leave it to the next one
+                    if dec is decoders[-1]:
+                        raise
         return decoder.decode(filepath)
 
     def _encode(self, audio_format, decoder_process,
                 bitrate=None, encoder=None):
         """find the correct encoder and pass in the decoder process,
-        returns the encoder process"""
+        returns the encoder process, or the generator of an in-process
+        encoder"""
         if not bitrate:
             bitrate = self.bitrate.get(audio_format)
         if not bitrate:
-            bitrate = 128
+            bitrate = DEFAULT_BITRATE
         if not encoder:
             for enc in self.available_encoders:
                 if enc.filetype == audio_format:
@@ -258,33 +432,65 @@ class AudioTranscode:
         self.check_encoder_available(newformat)
         decoder_process = None
         encoder_process = None
+        feeder = None
         try:
             decoder_process = self._decode(filepath, decoder)
             encoder_process = self._encode(newformat, decoder_process,
                                            bitrate=bitrate, encoder=encoder)
-            while encoder_process.poll() is None:
-                data = encoder_process.stdout.read(AudioTranscode.READ_BUFFER)
-                if data is None:
-                    time.sleep(0.1)  # wait for new data...
-                    break
+            if isinstance(encoder_process, subprocess.Popen):
+                if isinstance(decoder_process, subprocess.Popen):
+                    # the encoder has its own copy of the decoder's output.
+                    # Without this one, the decoder wouldn't notice if the
+                    # encoder died.
+                    decoder_process.stdout.close()
+                else:
+                    feeder = _Feeder(decoder_process, encoder_process.stdin)
+                    feeder.start()
+                output = read_output(encoder_process.stdout,
+                                     AudioTranscode.MIN_READ_BUFFER,
+                                     AudioTranscode.READ_BUFFER,
+                                     AudioTranscode.STALL_TIMEOUT)
+            else:
+                output = encoder_process
+
+            for data in output:
                 yield data
-        except Exception as exc:
-            #pass on exception, but clean up
-            raise exc
+
+            # a stream that ended early must not be mistaken for a whole one
+            if feeder:
+                feeder.join()
+            if feeder and feeder.error:
+                raise TranscodeError('Transcoding %s failed: %s'
+                                     % (filepath, feeder.error))
+            for process in [decoder_process, encoder_process]:
+                if isinstance(process, subprocess.Popen) and process.wait():
+                    raise TranscodeError('Transcoding %s failed' % filepath)
         finally:
-            if decoder_process and decoder_process.poll() is None:
-                if decoder_process.stderr:
-                    decoder_process.stderr.close()
-                if decoder_process.stdout:
-                    decoder_process.stdout.close()
-                if decoder_process.stdin:
-                    decoder_process.stdin.close()
-                decoder_process.terminate()
-            if encoder_process:
-                encoder_process.stdout.read()
-                encoder_process.stdout.close()
-                if encoder_process.stdin:
-                    encoder_process.stdin.close()
-                if encoder_process.stderr:
-                    encoder_process.stderr.close()
-                encoder_process.wait()
+            # the client may have gone away before the end of the stream, so
+            # nothing can be expected to finish on its own
+            processes = [process for process in [encoder_process,
+                                                 decoder_process]
+                         if isinstance(process, subprocess.Popen)]
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+            if feeder:
+                # its writes fail once the encoder is gone. It closes the
+                # encoder's stdin and the decoder itself.
+                feeder.join()
+            for process in processes:
+                for pipe in [process.stdin, process.stdout, process.stderr]:
+                    if pipe:
+                        pipe.close()
+                process.wait()
+            for generator in [encoder_process, decoder_process]:
+                if hasattr(generator, 'close') and not feeder:
+                    generator.close()
+
+
+def refresh():
+    """searches the PATH again for the command of every encoder and decoder,
+    e.g. after one was installed. The commands are only looked for once per
+    process otherwise."""
+    for transcoder in AudioTranscode.Encoders + AudioTranscode.Decoders:
+        transcoder.installed = transcoder.probe()
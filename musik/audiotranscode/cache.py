@@ -0,0 +1,120 @@
+"""A disk cache of transcoded audio streams.
+Transcoding a track takes far longer than reading it from disk, and the same popular tracks are
+requested in the same formats over and over again. The first request for a track in a format
+transcodes it as usual, and the output is written to the cache as it is streamed to the client.
+Later requests are served straight from the cached file, which, unlike a live transcode, has a
+known length and can be seeked in.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+
+class TranscodeCache(object):
+    """A directory of transcoded files that is kept under a size budget by deleting the least
+    recently used files first. The access time of each file is its last use. Its modification
+    time is left alone, because that is what clients validate their copies of the file against.
+    Files are named after the track, the modification time of its source file, the format and
+    the bitrate, so editing a track's file makes its cached versions unreachable, and they are
+    evicted in due course.
+    """
+    directory = None    # where the cached files are kept
+    max_size = 0        # maximum total size of the cached files in bytes. 0 turns the cache off.
+    size = 0            # total size of the cached files in bytes
+    lock = None         # files are added by several streaming threads at once
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if self.max_size <= 0:
+            return
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            if name.endswith('.part'):
+                # the remains of a transcode that was interrupted when the server stopped
+                os.remove(os.path.join(directory, name))
+            else:
+                self.size += os.path.getsize(os.path.join(directory, name))
+
+    def path(self, track_id, source_mtime, audio_format, bitrate):
+        """Returns the path of the cached copy of the specified track in the specified format"""
+        return os.path.join(self.directory, '%d-%x-%d.%s' % (track_id, int(source_mtime), bitrate, audio_format))
+
+    def get(self, path):
+        """Returns True if a file is cached at the specified path, and marks it as used"""
+        if self.max_size <= 0:
+            return False
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            return True
+        except OSError:
+            return False
+
+    def record(self, path, chunks):
+        """Yields each of the chunks of a transcoded stream, and writes them to the cache at the
+        specified path as it goes. The file only appears at path once the whole stream has been
+        written, so it is never served incomplete. If the stream fails or the client goes away
+        before the end, the partial file is thrown away."""
+        output = None
+        part = '%s.%s.part' % (path, uuid.uuid4().hex)
+        if self.max_size > 0:
+            try:
+                output = open(part, 'wb')
+            except IOError:
+                pass
+
+        complete = False
+        try:
+            for chunk in chunks:
+                if output != None:
+                    try:
+                        output.write(chunk)
+                    except IOError:
+                        # probably out of disk space. Carry on streaming without caching
+                        output.close()
+                        output = None
+                        os.remove(part)
+                yield chunk
+            complete = True
+        finally:
+            if output != None:
+                output.close()
+                size = os.path.getsize(part)
+                if complete and 0 < size <= self.max_size:
+                    os.rename(part, path)
+                    with self.lock:
+                        self.size += size
+                        self.evict()
+                else:
+                    os.remove(part)
+
+    def evict(self):
+        """Deletes the least recently used files until the cache fits within max_size. The
+        caller must hold the lock."""
+        if self.size <= self.max_size:
+            return
+
+        # the directory is the authority on what is cached, in case files were deleted by hand
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.part'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                    files.append((st.st_atime, st.st_size, name))
+                except OSError:
+                    pass
+        self.size = sum(size for (atime, size, name) in files)
+
+        for (atime, size, name) in sorted(files):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.size -= size
+            except OSError:
+                pass
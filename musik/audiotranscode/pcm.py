@@ -0,0 +1,98 @@
+"""In-process decoding of uncompressed audio.
+Decoders hand their output to encoders as a WAV stream of 16 bit, 44.1kHz, stereo PCM, which is
+what the raw input options of the external encoders assume. A WAV file that is already in that
+format only needs its header rewritten, and one that isn't can be converted with the buffer
+operations in audioop, which work on whole blocks of samples at a time in C. Either way there
+is no need to start a decoder process and copy the file through a pipe.
+"""
+
+import audioop
+import struct
+import wave
+
+
+CHANNELS = 2
+SAMPLE_WIDTH = 2    # bytes per sample
+SAMPLE_RATE = 44100
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+
+# bytes of output per block that is read and converted
+BLOCK_SIZE = 65536
+
+
+class FormatError(Exception):
+    """exception if a file can't be decoded in-process"""
+    def __init__(self, value):
+        Exception.__init__(self, value)
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def wav_header(frames):
+    """returns the header of a WAV stream with the specified number of
+    frames in the pipeline's format"""
+    data_size = frames * FRAME_SIZE
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       'RIFF', 36 + data_size, 'WAVE',
+                       'fmt ', 16, 1, CHANNELS, SAMPLE_RATE,
+                       SAMPLE_RATE * FRAME_SIZE, FRAME_SIZE, SAMPLE_WIDTH * 8,
+                       'data', data_size)
+
+
+def decode_wav(filepath):
+    """returns a generator of a WAV stream in the pipeline's format that is
+    converted from the WAV file at filepath. Raises FormatError straight
+    away if the file isn't PCM that audioop can convert, such as 24 bit or
+    floating point audio."""
+    try:
+        source = wave.open(filepath, 'rb')
+    except (wave.Error, EOFError) as exc:
+        raise FormatError('%s is not a PCM WAV file: %s' % (filepath, exc))
+    (channels, width, rate, frames) = source.getparams()[:4]
+    if channels not in [1, 2] or width not in [1, 2, 4]:
+        source.close()
+        raise FormatError('%s has %d channels of %d bit samples'
+                          % (filepath, channels, width * 8))
+    return _convert(source, channels, width, rate, frames)
+
+
+def _convert(source, channels, width, rate, frames):
+    """yields the frames of an open WAV file, converted to the pipeline's
+    format and preceded by a header"""
+    try:
+        # resampling can round the length either way. The header is
+        # written first, so the output is cut or padded to match it.
+        output_frames = frames * SAMPLE_RATE // rate
+        remaining = output_frames * FRAME_SIZE
+        yield wav_header(output_frames)
+
+        block_frames = max(1, BLOCK_SIZE * rate // SAMPLE_RATE // FRAME_SIZE)
+        state = None
+        while remaining > 0:
+            data = source.readframes(block_frames)
+            if not data:
+                # the file is shorter than its header says
+                break
+            if width == 1:
+                # 8 bit WAV samples are unsigned, and audioop's are signed
+                data = audioop.bias(data, 1, -128)
+            if width != SAMPLE_WIDTH:
+                data = audioop.lin2lin(data, width, SAMPLE_WIDTH)
+            if channels == 1:
+                data = audioop.tostereo(data, SAMPLE_WIDTH, 1, 1)
+            if rate != SAMPLE_RATE:
+                (data, state) = audioop.ratecv(data, SAMPLE_WIDTH, CHANNELS,
+                                               rate, SAMPLE_RATE, state)
+            data = data[:remaining]
+            remaining -= len(data)
+            yield data
+
+        # silence, so that the stream is as long as its header says
+        while remaining > 0:
+            padding = min(remaining, BLOCK_SIZE)
+            remaining -= padding
+            yield '\0' * padding
+    finally:
+        source.close()
@@ -0,0 +1,158 @@
+"""Limits the number of transcoding pipelines that run at once.
+Every transcode runs a decoder and an encoder process for as long as the client keeps reading
+the stream, so an unbounded burst of requests can start hundreds of processes that all compete
+for the same processors. The scheduler hands out a fixed number of slots. Requests that can't
+have one straight away wait in a first-come, first-served queue for a while, and a single client
+can only hold a few slots at a time, running or waiting, so that it can't crowd out everybody
+else. Requests that don't get a slot in time are turned away so that the client can try again
+later instead of waiting indefinitely.
+"""
+
+from collections import deque
+import math
+import threading
+import time
+
+
+class SchedulerBusy(Exception):
+    """raised when a transcoding pipeline can't be started because the scheduler is saturated"""
+    def __init__(self, value, retry_after):
+        Exception.__init__(self, value)
+        self.value = value
+        self.retry_after = retry_after  # seconds after which the client should try again
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Slot(object):
+    """permission to run one transcoding pipeline. The slot must be released when the pipeline
+    finishes. Releasing it more than once is harmless."""
+    def __init__(self, scheduler, client):
+        self.scheduler = scheduler
+        self.client = client
+        self.granted = False    # set by the scheduler once the slot can be used
+        self.released = False
+
+    def release(self):
+        self.scheduler.release(self)
+
+
+class TranscodeScheduler(object):
+    """Hands out slots for transcoding pipelines in the order that they were asked for"""
+    max_pipelines = 0       # number of pipelines that may run at once. 0 removes the limit.
+    max_per_client = 0      # number of pipelines that one client may run or wait for at once. 0 removes the limit.
+    max_queue = 0           # number of requests that may wait for a slot at once
+    max_wait = 0            # seconds that a request waits for a slot before it is turned away
+    running = 0             # number of slots that are in use
+    queue = None            # slots that are waiting to be granted, oldest first
+    clients = None          # number of slots that each client is running or waiting for
+    lock = None             # slots are requested and released by several streaming threads at once
+    condition = None        # notified whenever slots are granted
+
+    # metrics
+    admitted = 0            # number of slots that were granted
+    rejected = 0            # number of requests that were turned away without waiting
+    timed_out = 0           # number of requests that were turned away after waiting max_wait
+    total_wait = 0.0        # total seconds that granted slots spent in the queue
+    longest_wait = 0.0      # longest time in seconds that a granted slot spent in the queue
+
+    def __init__(self, max_pipelines, max_per_client, max_queue, max_wait):
+        self.max_pipelines = max_pipelines
+        self.max_per_client = max_per_client
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queue = deque()
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    def acquire(self, client):
+        """Returns a Slot for a pipeline that was requested by the specified client, such as its
+        address, waiting for one to become free if necessary.
+        Raises SchedulerBusy if the client already has as many pipelines as it is allowed, if
+        the queue is full, or if no slot became free within max_wait seconds."""
+        retry_after = max(1, int(math.ceil(self.max_wait)))
+        slot = Slot(self, client)
+        with self.lock:
+            if self.max_per_client > 0 and self.clients.get(client, 0) >= self.max_per_client:
+                self.rejected += 1
+                raise SchedulerBusy('%s already has %d transcodes in progress' % (client, self.max_per_client), retry_after)
+            if len(self.queue) >= self.max_queue and not self._is_free():
+                self.rejected += 1
+                raise SchedulerBusy('Too many transcodes are waiting to start', retry_after)
+
+            self.clients[client] = self.clients.get(client, 0) + 1
+            self.queue.append(slot)
+            self._grant()
+
+            queued = time.time()
+            deadline = queued + self.max_wait
+            while not slot.granted:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.queue.remove(slot)
+                    self._forget(client)
+                    self.timed_out += 1
+                    raise SchedulerBusy('No transcode finished within %d seconds' % self.max_wait, retry_after)
+                self.condition.wait(remaining)
+
+            waited = time.time() - queued
+            self.admitted += 1
+            self.total_wait += waited
+            self.longest_wait = max(self.longest_wait, waited)
+        return slot
+
+    def release(self, slot):
+        """Frees a slot that was returned by acquire so that the next request in the queue can
+        have it"""
+        with self.lock:
+            if slot.released:
+                return
+            slot.released = True
+            self.running -= 1
+            self._forget(slot.client)
+            self._grant()
+
+    def is_saturated(self):
+        """Returns True if a pipeline that was requested now would have to wait for a slot"""
+        with self.lock:
+            return len(self.queue) > 0 or not self._is_free()
+
+    def _is_free(self):
+        return self.max_pipelines <= 0 or self.running < self.max_pipelines
+
+    def _grant(self):
+        """Grants free slots to the requests at the front of the queue. The caller must hold
+        the lock."""
+        granted = False
+        while len(self.queue) > 0 and self._is_free():
+            slot = self.queue.popleft()
+            slot.granted = True
+            self.running += 1
+            granted = True
+        if granted:
+            self.condition.notify_all()
+
+    def _forget(self, client):
+        """Counts one less pipeline for the specified client. The caller must hold the lock."""
+        count = self.clients.get(client, 0) - 1
+        if count > 0:
+            self.clients[client] = count
+        else:
+            self.clients.pop(client, None)
+
+    def stats(self):
+        """Returns a dictionary that describes the current load and how long requests have
+        had to wait for a slot"""
+        with self.lock:
+            return {
+                'max_pipelines': self.max_pipelines,
+                'running': self.running,
+                'queued': len(self.queue),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'mean_wait': self.total_wait / self.admitted if self.admitted > 0 else 0.0,
+                'longest_wait': self.longest_wait,
+            }
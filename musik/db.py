@@ -2,13 +2,19 @@ import datetime
 import hashlib
 import os
 import os.path
+import threading
+import time
 import uuid
 
+from musik import aggregates
 from musik import config
+from musik import migrations
+from musik import search
 
-from sqlalchemy import Column, create_engine, ForeignKey
+from sqlalchemy import Column, create_engine, event, ForeignKey, Index
+from sqlalchemy.exc import DisconnectionError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.types import String, Integer, DateTime, Boolean, BigInteger, Enum
+from sqlalchemy.types import String, Integer, DateTime, Boolean, BigInteger, Enum, Float
 from sqlalchemy.orm import backref, relationship, sessionmaker
 
 
@@ -67,13 +73,22 @@ class User(Base):
         return u
 
 
+class SchemaVersion(Base):
+    """Records each schema migration that has been applied to the database. See musik.migrations"""
+    __tablename__ = 'schema_versions'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied = Column(DateTime, nullable=False)
+
+
 class LogEntry(Base):
     """Error and warning messages are written to the database and to log files."""
     __tablename__ = 'log_entries'
 
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, nullable=False)
-    severity = Column(Enum('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', name='severity'), nullable=False)
+    severity = Column(Enum('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', name='severity', native_enum=False), nullable=False)
     classpath = Column(String)
     message = Column(String)
     stack_trace = Column(String, nullable=True)
@@ -108,14 +123,16 @@ class ImportTask(Base):
     __tablename__ = 'import_tasks'
     id = Column(Integer, primary_key=True)
 
-    uri = Column(String)
+    uri = Column(String, index=True)
     created = Column(DateTime)
     started = Column(DateTime)
     completed = Column(DateTime)
+    incremental = Column(Boolean, default=False)    # only re-read files that changed since the last import
 
-    def __init__(self, uri):
+    def __init__(self, uri, incremental=False):
         Base.__init__(self)
         self.uri = uri
+        self.incremental = incremental
         self.created = datetime.datetime.utcnow()
 
     def __unicode__(self):
@@ -142,32 +159,27 @@ class Artist(Base):
     """
     __tablename__ = 'artists'
     id = Column(Integer, primary_key=True)  # unique id
-    name = Column(String)                   # artist name
-    name_sort = Column(String)              # sortable artist name
-    musicbrainz_artistid = Column(String)   # unique 36-digit musicbrainz hex string
+    name = Column(String, index=True)                   # artist name
+    name_sort = Column(String, index=True)              # sortable artist name
+    musicbrainz_artistid = Column(String, index=True, unique=True)  # unique 36-digit musicbrainz hex string
 
-    # TODO: make musicbrainz_artistid unique!
+    # totals that are kept up to date by musik.aggregates so that they can be read without loading any albums or tracks
+    album_count = Column(Integer, default=0, index=True)    # number of albums linked to this artist
+    track_count = Column(Integer, default=0, index=True)    # number of tracks on albums linked to this artist
+    length = Column(BigInteger, default=0, index=True)      # total length of those tracks in seconds
 
     def __init__(self, name):
         Base.__init__(self)
         self.name = name
         self.name_sort = name
 
-    # calculates the number of tracks linked to this artist by expanding its albums link
+    # returns the number of tracks on albums linked to this artist
     def numTracks(self):
-        numTracks = 0;
-        if self.albums is None:
-            return 0;
+        return self.track_count or 0
 
-        for album in self.albums:
-            numTracks += album.numTracks();
-        return numTracks;
-
-    # calculates the number of albums linked to this artist by expanding its albums link
+    # returns the number of albums linked to this artist
     def numAlbums(self):
-        if self.albums is None:
-            return 0;
-        return len(self.albums);
+        return self.album_count or 0
 
     def __unicode__(self):
         return u'<Artist(name=%s)>' % self.name
@@ -186,7 +198,7 @@ class Artist(Base):
                 artist_dict[column.name] = getattr(self, column.name)
 
         # add computed columns to the dict
-        if self.albums is not None and 'albums' not in ignored:
+        if 'albums' not in ignored and self.albums is not None:
             # when adding this artist's albums, we have to ignore their artist field because including
             # it causes infinite recursion and a stack overflow
             artist_dict['albums'] = sorted([album.as_dict(ignored=['artist', 'discs', 'tracks']) for album in self.albums], key=lambda album: album['title_sort'])
@@ -211,19 +223,26 @@ class Album(Base):
     id = Column(Integer, primary_key=True)                  # unique id
     albumstatus = Column(String)                            # musicbrainz album status
     albumtype = Column(String)                              # musicbrainz album type
-    artist_id = Column(Integer, ForeignKey('artists.id'))   # the artist that recorded this album
+    artist_id = Column(Integer, ForeignKey('artists.id'), index=True)   # the artist that recorded this album
     asin = Column(String)                                   # amazon standard identification number - only if physical
     catalognum = Column(String)                             # a quasi-unique identifier assigned to the album by the label
     compilation = Column(Boolean)                           # whether or not this album is a compilation
     country = Column(String)                                # the country that this album was released in
     label = Column(String)                                  # the record label that released this album
-    mb_albumid = Column(String)                             # unique 36-digit musicbrainz hex string
+    mb_albumid = Column(String, index=True)                 # unique 36-digit musicbrainz hex string
     mb_releasegroupid = Column(String)                      # unique identifer of label that released the album
     media_type = Column(String)                             # the type of media (CD, etc)
     title = Column(String)                                  # the title of the album
-    title_sort = Column(String)                             # sortable title of the album
+    title_sort = Column(String, index=True)                 # sortable title of the album
     year = Column(Integer)                                  # the year in which the album was released
 
+    # totals that are kept up to date by musik.aggregates so that they can be read without loading any tracks
+    track_count = Column(Integer, default=0, index=True)    # number of tracks linked to this album
+    length = Column(BigInteger, default=0, index=True)      # total length of those tracks in seconds
+
+    # the importer looks albums up by title within an artist
+    __table_args__ = (Index('ix_albums_title_artist_id', 'title', 'artist_id'),)
+
     # computed columns that link to other objects
     artist = relationship('Artist', backref=backref('albums', order_by=id))
 
@@ -234,9 +253,7 @@ class Album(Base):
 
     # returns the number of tracks linked to this album
     def numTracks(self):
-        if self.tracks is None:
-            return 0;
-        return len(self.tracks);
+        return self.track_count or 0
 
     def __unicode__(self):
         return u'<Album(title=%s)>' % self.title
@@ -255,15 +272,15 @@ class Album(Base):
                 album_dict[column.name] = getattr(self, column.name)
 
         # add computed columns to dict
-        if self.artist is not None and 'artist' not in ignored:
+        if 'artist' not in ignored and self.artist is not None:
             album_dict['artist'] = self.artist.as_dict(ignored=['albums'])
 
-        if self.discs is not None and 'discs' not in ignored:
+        if 'discs' not in ignored and self.discs is not None:
             # all discs have the same album as a parent, so ignore this attribute on child discs or
             # else risk a stack overflow thanks to unbounded recursion
             album_dict['discs'] = sorted([disc.as_dict(ignored=['album', 'tracks']) for disc in self.discs], key=lambda disc: (0 if disc['discnumber'] is None else int(disc['discnumber'])))
 
-        if self.tracks is not None and 'tracks' not in ignored:
+        if 'tracks' not in ignored and self.tracks is not None:
             # no need to include all of the computed columns for every track - that would be a waste
             album_dict['tracks'] = sorted([track.as_dict(ignored=['album', 'album_artist', 'artist', 'disc']) for track in self.tracks], key=lambda track: (0 if track['tracknumber'] is None else int(track['tracknumber'])))
 
@@ -293,8 +310,11 @@ class Disc(Base):
     disc_subtitle = Column(String)                       # the subtitle (if applicable) of this disc
     num_tracks = Column(Integer)                         # total tracks on the disc
 
+    # the importer looks discs up by number within an album
+    __table_args__ = (Index('ix_discs_album_id_discnumber', 'album_id', 'discnumber'),)
+
     # relationships
-    album = relationship('Album', backref=backref('discs', order_by=discnumber, lazy='dynamic'))
+    album = relationship('Album', backref=backref('discs', order_by=discnumber))
 
     def __init__(self, discnumber):
         Base.__init__(self)
@@ -321,7 +341,7 @@ class Disc(Base):
             disc_dict['album'] = self.album.as_dict()
 
         if 'tracks' not in ignored:
-            disc_dict['tracks'] = sorted([track.as_dict() for track in self.trackcks], key=lambda track: int(track['tracknumber']))
+            disc_dict['tracks'] = sorted([track.as_dict() for track in self.tracks], key=lambda track: (0 if track['tracknumber'] is None else int(track['tracknumber'])))
 
         return disc_dict
 
@@ -335,10 +355,10 @@ class Track(Base):
 
     # fields from metadata
     id = Column(Integer, primary_key=True)                      # unique id
-    uri = Column(String)                                        # physical location of the track file
-    album_id = Column(Integer, ForeignKey('albums.id'))         # the album that contains the track
+    uri = Column(String, index=True)                            # physical location of the track file
+    album_id = Column(Integer, ForeignKey('albums.id'), index=True)     # the album that contains the track
     albumartist_id = Column(Integer, ForeignKey('artists.id'))  # the artist that recorded the album
-    artist_id = Column(Integer, ForeignKey('artists.id'))       # the artist that recorded the track
+    artist_id = Column(Integer, ForeignKey('artists.id'), index=True)   # the artist that recorded the track
     bitdepth = Column(Integer)                                  # Number of bits per sample
     bitrate = Column(Integer)                                   # Number of bits per second
     bpm = Column(Integer)                                       # beats per minute
@@ -346,16 +366,16 @@ class Track(Base):
     comments = Column(String)                                   # Comments
     composer_id = Column(Integer, ForeignKey('artists.id'))     # the artist that composed the track
     date = Column(DateTime)                                     # date that the track was released
-    disc_id = Column(Integer, ForeignKey('discs.id'))           # disc of the album that the track appeared on
+    disc_id = Column(Integer, ForeignKey('discs.id'), index=True)       # disc of the album that the track appeared on
     encoder = Column(String)                                    # encoder that created the digital file
     format = Column(String)                                     # the file format/codec
-    genre = Column(String)                                      # genre of track contents
+    genre = Column(String, index=True)                          # genre of track contents
     language = Column(String)                                   # language code
     length = Column(BigInteger)                                 # length of the track in seconds
     lyrics = Column(String)                                     # the lyrics to the song
     mb_trackid = Column(String)                                 # unique 36-digit musicbrainz hex string
     samplerate = Column(Integer)                                # sample rate
-    title = Column(String)                                      # title of the track
+    title = Column(String, index=True)                          # title of the track
     tracknumber = Column(Integer)                               # order of the track on the disc
 
     # custom fields
@@ -363,6 +383,12 @@ class Track(Base):
     rating = Column(Integer)                                    # rating of the track (0-255)
     mimetype = Column(String)                                   # IANA mimetype of the file
 
+    # fingerprint of the file as of the last import, used to skip unchanged files on rescan
+    file_size = Column(BigInteger)                              # size of the file in bytes
+    file_mtime = Column(Float)                                  # modification time of the file
+    file_hash = Column(String)                                  # hash of the head and tail of the file (optional)
+    missing = Column(Boolean, default=False)                    # the file could not be found on the last rescan
+
     # relationships
     album = relationship('Album', backref=backref('tracks', order_by=tracknumber))
     album_artist = relationship('Artist', primaryjoin='Artist.id == Track.albumartist_id')
@@ -391,16 +417,16 @@ class Track(Base):
                 track_dict[column.name] = getattr(self, column.name)
 
         # add computed columns to dict
-        if self.album is not None and 'album' not in ignored:
+        if 'album' not in ignored and self.album is not None:
             track_dict['album'] = self.album.as_dict(ignored=['artist'])
 
-        if self.album_artist is not None and 'album_artist' not in ignored:
+        if 'album_artist' not in ignored and self.album_artist is not None:
             track_dict['album_artist'] = self.album_artist.as_dict(ignored=['albums'])
 
-        if self.artist is not None and 'artist' not in ignored:
+        if 'artist' not in ignored and self.artist is not None:
             track_dict['artist'] = self.artist.as_dict(ignored=['albums'])
 
-        if self.disc is not None and 'disc' not in ignored:
+        if 'disc' not in ignored and self.disc is not None:
             track_dict['disc'] = self.disc.as_dict(ignored=['tracks'])
 
         return track_dict
@@ -415,7 +441,7 @@ class UserAction(Base):
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, nullable=False)
     userId = Column(Integer, ForeignKey('users.id'), nullable=False)
-    actionType = Column(Enum('LOG_IN', 'START_TRACK', 'COMPLETE_TRACK', 'SKIP_TRACK', name='action_type'), nullable=False)
+    actionType = Column(Enum('LOG_IN', 'START_TRACK', 'COMPLETE_TRACK', 'SKIP_TRACK', name='action_type', native_enum=False), nullable=False)
     artistId = Column(Integer, ForeignKey('artists.id'))
     albumId = Column(Integer, ForeignKey('albums.id'))
     trackId = Column(Integer, ForeignKey('tracks.id'))
@@ -429,6 +455,65 @@ class UserAction(Base):
         self.trackId = trackId
 
 
+class LibraryGeneration(object):
+    """A counter that is advanced every time that a change to the artists, albums, discs or tracks
+    in the library is committed by this process. Anything that is derived from the library, such as
+    a cached API response, is still valid as long as the generation that it was derived from is
+    current.
+    The counter starts over whenever the process starts, so started is included wherever the
+    generation leaves the process, e.g. in an ETag.
+    """
+    started = None      # unix time at which the process started counting
+    value = 0           # number of library changes that have been committed
+    modified = None     # unix time of the most recent library change
+    lock = None
+
+    def __init__(self):
+        self.started = int(time.time())
+        self.modified = self.started
+        self.lock = threading.Lock()
+
+    def current(self):
+        """Returns a (value, modified) tuple that describes the current generation"""
+        with self.lock:
+            return (self.value, self.modified)
+
+    def advance(self):
+        """Starts a new generation. Called after a change to the library is committed."""
+        with self.lock:
+            self.value += 1
+            # Last-Modified only has a resolution of one second, so every generation gets a
+            # different second even if several changes are committed within the same one
+            self.modified = max(self.modified + 1, int(time.time()))
+
+
+library_generation = LibraryGeneration()
+
+
+def _sqlite_connect_listener(pragmas):
+    """Returns a function that configures each new SQLite connection by applying each
+    (name, value) pair in pragmas to it.
+    """
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for (name, value) in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return on_connect
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Makes sure that a pooled connection is still alive before handing it out. If the
+    database server dropped it, the pool throws it away and connects again."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+
 # Loosely wraps the SQLAlchemy database types and access methods.
 # The goal here isn't to encapsulate SQLAlchemy. Rather, we want dictate
 # to the process of connecting to and disconnecting from the db,
@@ -436,25 +521,55 @@ class UserAction(Base):
 # TODO: refactor the class and function names to follow python spec
 class DatabaseWrapper:
 
-    db_path = None
+    db_url = None
     sa_engine = None
     sa_sessionmaker = None
+    initialized = set()     # databases whose schema has already been checked by this process
+    engines = {}            # one engine (and connection pool) per database url, shared by the whole process
+    engines_lock = threading.Lock()
 
     def __init__(self):
         """Creates a new instance of the DatabaseWrapper.
         This function starts a new database engine and ensures that the
         database has been initialized.
+        The database is identified by the url setting of the Database section of the config file.
+        If it is blank, a SQLite database at the General database_path is used.
         """
-        self.db_path = config.get("General", "database_path")
+        self.db_url = config.get("Database", "url")
+        if self.db_url == '':
+            self.db_url = 'sqlite:///%s' % config.get("General", "database_path")
         self.init_database()
 
     def get_engine(self):
         """Initializes and returns an instance of sqlalchemy.engine.base.Engine
         """
         if self.sa_engine == None:
-            self.sa_engine = create_engine('sqlite:///%s' % self.db_path, echo=False)
+            with DatabaseWrapper.engines_lock:
+                if self.db_url not in DatabaseWrapper.engines:
+                    DatabaseWrapper.engines[self.db_url] = self.create_engine()
+            self.sa_engine = DatabaseWrapper.engines[self.db_url]
         return self.sa_engine
 
+    def create_engine(self):
+        """Creates an engine for db_url that is configured according to its dialect"""
+        if self.db_url.startswith('sqlite'):
+            engine = create_engine(self.db_url, echo=False)
+
+            # write-ahead logging lets API requests keep reading while the importer writes, and
+            # busy_timeout makes writers wait for each other instead of failing with "database is locked"
+            pragmas = [(name, config.get('Database', name)) for name in ['journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size']]
+            event.listen(engine, 'connect', _sqlite_connect_listener(pragmas))
+        else:
+            # client/server databases get a pool of connections that is shared by every thread
+            engine = create_engine(self.db_url, echo=False,
+                                   pool_size=int(config.get('Database', 'pool_size')),
+                                   max_overflow=int(config.get('Database', 'pool_max_overflow')),
+                                   pool_timeout=int(config.get('Database', 'pool_timeout')),
+                                   pool_recycle=int(config.get('Database', 'pool_recycle')))
+            if config.get('Database', 'pool_pre_ping') == 'true':
+                event.listen(engine, 'checkout', _ping_connection)
+        return engine
+
     def init_database(self):
         """Initializes the database schema
         This method is not thread-safe; users must take steps to ensure that it is
@@ -463,7 +578,33 @@ class DatabaseWrapper:
         """
         if self.sa_engine == None:
             self.get_engine()
-        Base.metadata.create_all(self.sa_engine)
+
+        # every thread and log handler creates its own DatabaseWrapper, but the schema
+        # only needs to be checked once per process
+        if self.db_url in DatabaseWrapper.initialized:
+            return
+
+        migrations.upgrade(self.sa_engine, Base.metadata)
+        search.init_index(self.sa_engine)
+        DatabaseWrapper.initialized.add(self.db_url)
+
+    def optimize(self, reindex=False):
+        """Refreshes the query planner's statistics after bulk changes to the library, and
+        optionally rebuilds every index first. See musik.migrations.optimize"""
+        if self.sa_engine == None:
+            self.get_engine()
+        migrations.optimize(self.sa_engine, reindex)
+        with self.sa_engine.begin() as connection:
+            search.optimize(connection)
+
+    def repair_aggregates(self):
+        """Recomputes the track counts, album counts and lengths of every album and artist in the
+        library and starts a new library generation. See musik.aggregates"""
+        if self.sa_engine == None:
+            self.get_engine()
+        with self.sa_engine.begin() as connection:
+            aggregates.repair(connection)
+        library_generation.advance()
 
     def get_session(self):
         """Initializes and returns an instance of sqlalchemy.engine.base.Engine
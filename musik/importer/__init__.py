@@ -1,20 +1,61 @@
 from datetime import datetime
+from sqlalchemy import and_, event, or_
+import functools
+import itertools
 import mimetypes
+import multiprocessing
 import os
 import re
 import threading
 import time
+import traceback
 
+from musik import aggregates
+from musik import config
 from musik import log
-from musik.db import DatabaseWrapper, ImportTask, Track, Album, Artist, Disc
+from musik import search
+from musik.db import DatabaseWrapper, ImportTask, Track, Album, Artist, Disc, library_generation
+from musik.importer.cache import IdentityCache
 from musik.importer.mediafile import MediaFile, UnreadableFileError
+from musik.importer.metadata import content_hash, fingerprint, init_worker, read_metadata, TrackMetadata
+from musik.importer.taskqueue import import_queue
+from musik.util import chunks
+
+try:
+    # the scandir package is much faster than os.walk because it avoids a stat call per entry
+    from scandir import walk
+except ImportError:
+    from os import walk
+
+
+def uri_under(directory):
+    """Returns a condition that matches the tracks whose files are anywhere under the specified
+    directory. Track.uri.startswith would compile to LIKE, which SQLite matches without regard to
+    case and in which _ and % in the directory's name are wildcards, so tracks in sibling
+    directories such as Rock next to rock would match too. A range of uris is compared instead,
+    which is exact and can use the index on uri."""
+    prefix = os.path.join(directory, '')
+    if isinstance(prefix, str):
+        prefix = prefix.decode('utf-8')
+    # the highest code point sorts after anything that can follow the prefix in a file name
+    return and_(Track.uri >= prefix, Track.uri < prefix + u'\U0010ffff')
 
 
 class ImportThread(threading.Thread):
 
     running = True      # whether or not the thread should continue to run
+    db = None           # database wrapper
     sa_session = None   # database session
     log = None          # logging instance
+    worker_count = 1    # number of processes that read file metadata in parallel
+    batch_size = 100    # maximum number of import tasks that are processed per transaction
+    enumeration_batch_size = 1000   # number of import tasks that are inserted per statement
+    hash_files = False  # whether or not to store a content hash alongside the size and mtime of each file
+    pool = None         # pool of metadata worker processes
+    identity_cache = None   # artists, albums and discs that have already been resolved during the current batch of tasks
+    optimize_threshold = 1000   # number of imported files after which the query planner statistics are refreshed
+    imported_since_optimize = 0
+    library_changed = False     # whether the current transaction has changed any artists, albums, discs or tracks
 
     def __init__(self):
         """Creates a new instance of ImportThread and connects to the database.
@@ -23,86 +64,291 @@ class ImportThread(threading.Thread):
         the same time.
         """
         super(ImportThread, self).__init__(name=__name__)
-        db = DatabaseWrapper()
-        self.sa_session = db.get_session()
+        self.db = DatabaseWrapper()
+        self.sa_session = self.db.get_session()
 
         # create a log object that uses the same session that we do so that we can write error messages
         # during transactions
         self.log = log.Log(__name__, self.sa_session)
 
+        self.worker_count = max(1, int(config.get('Importer', 'worker_count')))
+        self.batch_size = max(1, int(config.get('Importer', 'batch_size')))
+        self.enumeration_batch_size = max(1, int(config.get('Importer', 'enumeration_batch_size')))
+        self.hash_files = config.get('Importer', 'hash_files') == 'true'
+        self.optimize_threshold = int(config.get('Importer', 'optimize_threshold'))
+
+        # the importer is the only thing that writes artists, albums and discs, so the objects in
+        # its session (and in the identity cache) don't need to be reloaded after every commit
+        self.sa_session.expire_on_commit = False
+        self.identity_cache = IdentityCache(int(config.get('Importer', 'identity_cache_size')))
+        event.listen(self.sa_session, 'after_rollback', self.clear_identity_cache)
+
+        # every commit that changes the library starts a new library generation, which tells the
+        # API that the responses it has cached are out of date
+        event.listen(self.sa_session, 'after_flush', self.note_flushed_changes)
+        event.listen(self.sa_session, 'after_bulk_update', self.note_bulk_update)
+        event.listen(self.sa_session, 'after_commit', self.advance_library_generation)
+
     def run(self):
-        """Checks for new import tasks once per second and passes them off to
+        """Waits for uris to be pushed onto the import queue and passes them off to
         the appropriate handler functions for completion.
         """
         try:
+            # metadata extraction is cpu-bound, so it is farmed out to a pool of processes
+            # rather than threads in order to escape the GIL. Database writes stay on this thread.
+            if self.worker_count > 1:
+                self.log.info(u'Starting %d metadata worker processes' % self.worker_count)
+                self.pool = multiprocessing.Pool(self.worker_count, init_worker)
+
+            # jobs that were stopped while in progress will complete on startup
+            self.recover_tasks()
+
             # process 'till you drop
             while self.running:
-
-                # find the first uncompleted import task. This limits the
-                # importer to being single-threaded, but ensures that jobs
-                # that are stopped while in progress will complete on next
-                # startup.
-                task = self.sa_session.query(ImportTask).filter(ImportTask.completed == None).order_by(ImportTask.created).first()
-
-                if task != None:
-                    # start processing it
-                    task.started = datetime.utcnow()
-                    self.sa_session.commit()
-                    self.log.info(u'Processing task %s' % task.uri)
-
-                    # process the task
-                    if os.path.isdir(task.uri):
-                        self.log.info(u'Importing directory %s' % task.uri)
-                        self.import_directory(task.uri)
-                    elif os.path.isfile(task.uri):
-                        self.log.info(u'Importing file %s' % task.uri)
-                        self.import_file(task.uri)
-                    else:
-                        self.log.warning(u'Unrecognized URI %s' % task.uri)
-
-                    task.completed = datetime.utcnow()
-                    self.sa_session.commit()
-                    self.log.info(u'finished processing task %s' % task.uri)
-
-                time.sleep(1)
+                tasks = import_queue.get_batch(self.batch_size)
+                try:
+                    if len(tasks) > 0:
+                        self.process_tasks(tasks)
+
+                    # once a bulk import has drained the queue, give the query planner fresh statistics
+                    if self.imported_since_optimize >= self.optimize_threshold and import_queue.qsize() == 0:
+                        self.log.info(u'Refreshing database statistics after importing %d files' % self.imported_since_optimize)
+                        self.imported_since_optimize = 0
+                        self.db.optimize()
+                except Exception:
+                    # one bad batch mustn't stop the importer for good. Its tasks were marked as
+                    # started but never completed, so they are retried the next time it starts.
+                    self.sa_session.rollback()
+                    self.log.error(u'Failed to process a batch of %d import tasks: %s' % (len(tasks), traceback.format_exc().decode('utf-8', 'replace')))
         finally:
             # always clean up - your mom doesn't work here
+            if self.pool != None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
             if self.sa_session != None:
                 self.sa_session.close()
                 self.sa_session = None
 
-    def import_directory(self, uri):
+    def recover_tasks(self):
+        """Pushes every import task that the journal says is incomplete back onto the import queue"""
+        recovered = 0
+        seen = set()
+        for (uri, incremental) in self.sa_session.query(ImportTask.uri, ImportTask.incremental).filter(ImportTask.completed == None).order_by(ImportTask.created, ImportTask.id):
+            if uri not in seen:
+                seen.add(uri)
+                import_queue.put(uri, bool(incremental))
+                recovered += 1
+        self.sa_session.commit()
+
+        if recovered > 0:
+            self.log.info(u'Recovered %d incomplete import tasks' % recovered)
+
+    def update_journal(self, uris, column, since=None):
+        """Sets the specified datetime column of the incomplete import tasks for the specified
+        uris to the current time. If since is specified, only tasks that were created before
+        it are affected, so that a uri that was queued again while it was being processed
+        stays incomplete in the journal."""
+        now = datetime.utcnow()
+        for chunk in chunks(uris):
+            q = self.sa_session.query(ImportTask).filter(ImportTask.completed == None, ImportTask.uri.in_(chunk))
+            if since != None:
+                q = q.filter(ImportTask.created <= since)
+            q.update({column: now}, synchronize_session=False)
+
+    def process_tasks(self, tasks):
+        """Completes the specified import tasks, which are (uri, incremental) tuples.
+        Directories are enumerated one at a time, while all of the file tasks are
+        handed to import_files so that their metadata can be read in parallel.
+        """
+        started = datetime.utcnow()
+        self.update_journal([uri for (uri, incremental) in tasks], ImportTask.started)
+        self.sa_session.commit()
+
+        file_uris = []
+        for (uri, incremental) in tasks:
+            if os.path.isdir(uri):
+                self.log.info(u'Importing directory %s' % uri)
+                self.import_directory(uri, incremental)
+                self.update_journal([uri], ImportTask.completed, started)
+                self.sa_session.commit()
+                self.log.info(u'finished processing task %s' % uri)
+            elif os.path.isfile(uri):
+                file_uris.append(uri)
+            else:
+                # the file or directory was deleted or moved after the task was queued
+                missing = self.sa_session.query(Track).filter(or_(Track.uri == uri, uri_under(uri))).update({Track.missing: True}, synchronize_session=False)
+                if missing > 0:
+                    self.log.info(u'%s no longer exists. Marked %d tracks as missing.' % (uri, missing))
+                else:
+                    self.log.warning(u'Unrecognized URI %s' % uri)
+                self.update_journal([uri], ImportTask.completed, started)
+                self.sa_session.commit()
+
+        if len(file_uris) > 0:
+            self.import_files(file_uris, started)
+
+        # entities are only cached for one batch, so they aren't held while the importer is idle
+        self.identity_cache.clear()
+
+    def import_files(self, uris, started):
+        """Reads the metadata of the files at the specified uris using the worker pool
+        and adds the files to the library.
+        Workers only parse tags and hand back plain TrackMetadata records; this thread
+        is the only one that writes to the database, and it commits once per batch.
+        """
+        start = time.time()
+        reader = functools.partial(read_metadata, hash_files=self.hash_files)
+
+        if self.pool != None:
+            # hand each worker a few files at a time to amortize the cost of pickling
+            chunksize = max(1, len(uris) // (self.worker_count * 4))
+            results = self.pool.imap(reader, uris, chunksize)
+        else:
+            results = itertools.imap(reader, uris)
+
+        # results are returned in the same order as the uris that produced them
+        completed = []
+        for (uri, metadata, error) in results:
+            if not self.running:
+                # leave the remaining tasks for the next startup
+                break
+
+            self.log.info(u'Importing file %s' % uri)
+            if error != None:
+                self.log.error(error)
+            else:
+                self.import_file(uri, metadata)
+            completed.append(uri)
+
+        # the search index and the totals of the affected albums and artists are updated in the
+        # same transaction as the tracks themselves
+        self.sa_session.flush()
+        search.index_tracks(self.sa_session.connection(), completed)
+        aggregates.update_tracks(self.sa_session.connection(), completed)
+
+        self.update_journal(completed, ImportTask.completed, started)
+        self.sa_session.commit()
+        self.imported_since_optimize += len(completed)
+
+        elapsed = time.time() - start
+        if elapsed > 0:
+            self.log.info(u'Imported %d files in %.2f seconds (%.1f files/sec)' % (len(completed), elapsed, len(completed) / elapsed))
+        self.log.info(u'Identity cache holds %d entries (%d hits, %d misses)' % (len(self.identity_cache), self.identity_cache.hits, self.identity_cache.misses))
+
+    def clear_identity_cache(self, session):
+        """Empties the identity cache after the session is rolled back, since any artists,
+        albums or discs that were created but not committed no longer exist."""
+        self.identity_cache.clear()
+        self.library_changed = False
+
+    def note_flushed_changes(self, session, flush_context):
+        """Remembers whether a flush wrote any artists, albums, discs or tracks"""
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(instance, (Artist, Album, Disc, Track)):
+                self.library_changed = True
+                return
+
+    def note_bulk_update(self, session, query, query_context, result):
+        """Remembers whether a bulk update, such as marking tracks missing, changed the library"""
+        if query.column_descriptions[0]['type'] in (Artist, Album, Disc, Track) and result.rowcount != 0:
+            self.library_changed = True
+
+    def advance_library_generation(self, session):
+        """Starts a new library generation if the transaction that was just committed changed
+        the library"""
+        if self.library_changed:
+            self.library_changed = False
+            library_generation.advance()
+
+    def import_directory(self, uri, incremental=False):
         """Adds the specified directory to the library.
-        In practice, this implements a recursive breadth-first search over the
-        subtree rooted at uri. All files with a mimetype that starts with the
-        string 'audio' will be put back into the import queue for additional
-        processing. Returns True."""
-        search_queue = [uri]
-        while len(search_queue) > 0:
-            # this is the current working directory
-            baseuri = search_queue.pop(0)
-            if os.path.isdir(baseuri) == False:
-                continue
-
-            # TODO: directory permissions. Make sure that we can read before we try to
-            # iterate over the subdirectories and files in the current working directory
-            entries = os.listdir(baseuri)
-            for subdir in entries:
-
-                # if we found a directory, put it back on the queue. otherwise, process it
-                newuri = os.path.join(baseuri, subdir)
-                if os.path.isdir(newuri):
-                    search_queue.append(newuri)
-                elif os.path.isfile(newuri):
-                    if self.is_mime_type_supported(newuri):
-                        # create a new import task for useful files
-                        newtask = ImportTask(newuri)
-                        self.sa_session.add(newtask)
-                        self.sa_session.commit()
-                    else:
-                        self.log.info(u'Ignoring file %s' % newuri)
+        In practice, this walks the subtree rooted at uri. All files with a
+        mimetype that starts with the string 'audio' will be put back into the
+        import queue for additional processing. New tasks are inserted in bulk,
+        enumeration_batch_size rows at a time, and the whole directory is queued
+        in a single transaction.
+        If incremental is True, files whose size and modification time match the
+        fingerprint stored on their track are skipped, and tracks under uri whose
+        files have disappeared are marked as missing. Returns True."""
+        created = datetime.utcnow()
+        batch = []
+        queued = []
+        skipped = 0
+        start = time.time()
+
+        # the fingerprints of every track that is already in the library under this directory, keyed on uri
+        known = {}
+        if incremental:
+            for (track_uri, file_size, file_mtime, file_hash, missing) in self.sa_session.query(Track.uri, Track.file_size, Track.file_mtime, Track.file_hash, Track.missing).filter(uri_under(uri)):
+                known[track_uri] = (file_size, file_mtime, file_hash, missing)
+
+        # directories that can't be read are silently skipped by walk
+        for (dirpath, dirnames, filenames) in walk(uri):
+            for filename in filenames:
+                newuri = os.path.join(dirpath, filename)
+                if self.is_mime_type_supported(newuri):
+                    if newuri in known and self.is_unchanged(newuri, known.pop(newuri)):
+                        skipped += 1
+                        continue
+
+                    # create a new import task for useful files
+                    batch.append({'uri': newuri, 'created': created, 'incremental': False})
+                    queued.append(newuri)
+                    if len(batch) >= self.enumeration_batch_size:
+                        self.sa_session.execute(ImportTask.__table__.insert(), batch)
+                        batch = []
+                else:
+                    self.log.info(u'Ignoring file %s' % newuri)
+
+        if len(batch) > 0:
+            self.sa_session.execute(ImportTask.__table__.insert(), batch)
+
+        # anything that we knew about but didn't find on disk has been deleted or moved
+        vanished = [track_uri for (track_uri, (file_size, file_mtime, file_hash, missing)) in known.iteritems() if not missing]
+        for chunk in chunks(vanished):
+            self.sa_session.query(Track).filter(Track.uri.in_(chunk)).update({Track.missing: True}, synchronize_session=False)
+        if len(vanished) > 0:
+            self.log.info(u'Marked %d tracks under %s as missing' % (len(vanished), uri))
+
+        self.sa_session.commit()
+
+        # the journal is committed, so the files can be handed to the import queue
+        for newuri in queued:
+            import_queue.put(newuri)
+
+        self.log.info(u'Queued %d files from %s in %.2f seconds. %d unchanged files were skipped.' % (len(queued), uri, time.time() - start, skipped))
         return True
 
+    def is_unchanged(self, uri, known_fingerprint):
+        """Returns True if the file at the specified uri still matches the fingerprint that was
+        recorded when it was last imported, or False if it needs to be read again.
+        If a content hash is on record, files that were touched but whose size and content did
+        not change are also considered unchanged, and their stored mtime is brought up to date.
+        """
+        (file_size, file_mtime, file_hash, missing) = known_fingerprint
+        if missing or file_size == None or file_mtime == None:
+            return False
+
+        try:
+            current = fingerprint(uri)
+        except OSError:
+            return False
+
+        if current['file_size'] != file_size:
+            return False
+        if current['file_mtime'] == file_mtime:
+            return True
+
+        if self.hash_files and file_hash != None:
+            try:
+                if content_hash(uri, current['file_size']) == file_hash:
+                    self.sa_session.query(Track).filter(Track.uri == uri).update({Track.file_mtime: current['file_mtime']}, synchronize_session=False)
+                    return True
+            except IOError:
+                pass
+
+        return False
 
     def is_mime_type_supported(self, uri):
         """Takes a guess at the mimetype of the file at the specified uri.
@@ -119,9 +365,13 @@ class ImportThread(threading.Thread):
         return mimetype
 
 
-    def import_file(self, uri):
+    def import_file(self, uri, metadata=None):
         """Adds the specified file to the library.
-        Returns True if the file was successfully added to the database, or
+        metadata is the TrackMetadata record that was read from the file by a worker
+        process. If it is not specified, the file is read on this thread instead.
+        The changes are added to the current session, but it is the responsibility of
+        the calling function to commit them.
+        Returns True if the file was successfully added to the session, or
         False if metadata could not be read or the file could not be added."""
 
         # ensure that the uri isn't already in our library - we don't want duplicates
@@ -132,11 +382,12 @@ class ImportThread(threading.Thread):
         else:
             self.log.info(u'The file %s is already in the library. Updating metadata...' % uri)
 
-        try:
-            metadata = MediaFile(uri)
-        except UnreadableFileError:
-            self.log.error(u'Could not extract metadata from %s' % uri)
-            return False
+        if metadata == None:
+            try:
+                metadata = MediaFile(uri)
+            except UnreadableFileError:
+                self.log.error(u'Could not extract metadata from %s' % uri)
+                return False
 
         # artist
         artist = self.find_artist(metadata.artist, metadata.artist_sort, metadata.mb_artistid)
@@ -236,11 +487,8 @@ class ImportThread(threading.Thread):
         # disc
         if track.album != None:
             disc = self.find_disc(track.album, metadata.disc, metadata.disctitle, metadata.disctotal)
-            for d in track.album.discs:
-                if d.id == disc.id:
-                    # found disc is already linked - don't add it again
-                    disc = None
-            if disc != None:
+            # found disc is already linked - don't add it again
+            if disc != None and disc.album is not track.album:
                 track.album.discs.append(disc)
 
         #encoder
@@ -326,6 +574,20 @@ class ImportThread(threading.Thread):
         # mime type
         track.mimetype = self.guess_mime_type(uri)
 
+        # fingerprint - always overwritten, because it describes the file as it is right now
+        if isinstance(metadata, TrackMetadata):
+            # worker processes fingerprint the file while they read its tags
+            file_fingerprint = {'file_size': metadata.file_size, 'file_mtime': metadata.file_mtime, 'file_hash': metadata.file_hash}
+        else:
+            try:
+                file_fingerprint = fingerprint(uri, self.hash_files)
+            except (IOError, OSError):
+                file_fingerprint = {'file_size': None, 'file_mtime': None, 'file_hash': None}
+        track.file_size = file_fingerprint['file_size']
+        track.file_mtime = file_fingerprint['file_mtime']
+        track.file_hash = file_fingerprint['file_hash']
+        track.missing = False
+
         # if we couldn't determine track, album, artist from metadata, try to snag it from the path
         # track name = file name
         # album title = last directory in path,
@@ -353,9 +615,7 @@ class ImportThread(threading.Thread):
                     self.sa_session.add(artist)
 
         self.log.info(u'Added %s by %s to the current session.' % (track.title, track.artist.name))
-
-        #commit the transaction
-        self.sa_session.commit()
+        return True
 
     def find_artist(self, name='', name_sort='', musicbrainz_id=''):
         """Searches the database for an existing artist that matches the specified criteria.
@@ -367,7 +627,9 @@ class ImportThread(threading.Thread):
         if musicbrainz_id != '':
             # we trust musicbrainz_artistid the most because it infers that
             # some other tagger has already verified the metadata.
-            artist = self.sa_session.query(Artist).filter(Artist.musicbrainz_artistid == musicbrainz_id).first()
+            artist = self.identity_cache.get(('artist', 'mbid', musicbrainz_id))
+            if artist == None:
+                artist = self.sa_session.query(Artist).filter(Artist.musicbrainz_artistid == musicbrainz_id).first()
             if artist != None:
                 # found an existing artist in our db - compare its metadata
                 # to the new info. Always prefer existing metadata over new.
@@ -388,7 +650,9 @@ class ImportThread(threading.Thread):
         if artist == None and name != '':
             # if we don't have musicbrainz_artistid or there is no matching
             # artist in our db, try to find an existing artist by name
-            artist = self.sa_session.query(Artist).filter(Artist.name == name).first()
+            artist = self.identity_cache.get(('artist', 'name', name))
+            if artist == None:
+                artist = self.sa_session.query(Artist).filter(Artist.name == name).first()
             if artist != None:
                 self.log.info(u'Artist name search found existing artist %s in database' % artist.name)
                 # found an existing artist in our db - compare its metadata
@@ -408,6 +672,13 @@ class ImportThread(threading.Thread):
                 # add the artist object to the DB
                 self.log.info(u'Artist not found in database. Created new artist %s' % artist.name)
 
+        # remember the artist so that the next track by it doesn't have to hit the database
+        if artist != None:
+            if name != '':
+                self.identity_cache.put(('artist', 'name', name), artist)
+            if artist.musicbrainz_artistid:
+                self.identity_cache.put(('artist', 'mbid', artist.musicbrainz_artistid), artist)
+
         # return the artist that we found and/or created
         return artist
 
@@ -422,16 +693,23 @@ class ImportThread(threading.Thread):
         # we trust mb_albumid the most because it infers that
         # some other tagger has already verified the metadata.
         if musicbrainz_id != '':
-            album = self.sa_session.query(Album).filter(Album.mb_albumid == musicbrainz_id).first()
+            album = self.identity_cache.get(('album', 'mbid', musicbrainz_id))
+            if album == None:
+                album = self.sa_session.query(Album).filter(Album.mb_albumid == musicbrainz_id).first()
 
         # if we don't have mb_albumid or there is no matching
-        # album in our db, try to find an existing album by title and artist
+        # album in our db, try to find an existing album by title and artist.
+        # The artist object itself is part of the cache key because it may not have an id yet.
         if album == None and title != '' and artist != None:
-            album = self.sa_session.query(Album).filter(Album.title == title, Album.artist_id == artist.id).first()
+            album = self.identity_cache.get(('album', 'title', title, artist))
+            if album == None:
+                album = self.sa_session.query(Album).filter(Album.title == title, Album.artist_id == artist.id).first()
 
         # an existing album could not be found in our db. Make a new one
         if album == None:
             album = Album(title)
+            if musicbrainz_id != '':
+                album.mb_albumid = musicbrainz_id
             self.log.info(u'Album not found in database. Created new album %s' % album.title)
 
         # we either found or created the album. now verify its metadata
@@ -531,6 +809,12 @@ class ImportThread(threading.Thread):
                     # TODO: conflict!
                     self.log.warning(u'album.year conflict for track %s: %d != %d' % (metadata.title, album.year, metadata.year))
 
+        # remember the album so that the next track on it doesn't have to hit the database
+        if album.mb_albumid:
+            self.identity_cache.put(('album', 'mbid', album.mb_albumid), album)
+        if title != '' and artist != None:
+            self.identity_cache.put(('album', 'title', title, artist), album)
+
         return album
 
     def find_disc(self, album=None, discnumber=0, discsubtitle='', num_tracks=0):
@@ -540,7 +824,9 @@ class ImportThread(threading.Thread):
         # first see if there's a disc that's already linked to the album that
         # has either the specified musicbrainz_discid or discnumber.
         disc = None
-        if album != None:
+        if album != None and discnumber != 0:
+            disc = self.identity_cache.get(('disc', album, discnumber))
+        if disc == None and album != None:
             for d in album.discs:
                 if discnumber != 0:
                     if d.discnumber == discnumber:
@@ -551,21 +837,21 @@ class ImportThread(threading.Thread):
         if disc != None:
             self.log.info(u'Disc musicbrainz_discid/discnumber search found existing disc %s in database' % disc)
             if discnumber != 0:
-                if d.discnumber == None:
-                    d.discnumber = discnumber
-                elif d.discnumber != discnumber:
+                if disc.discnumber == None:
+                    disc.discnumber = discnumber
+                elif disc.discnumber != discnumber:
                     # TODO: conflict!
                     self.log.warning(u'Disc number conflict for disc %s: %s != %s' % (disc, disc.discnumber, discnumber))
             if discsubtitle != '':
-                if d.subtitle == None:
-                    d.subtitle = discsubtitle
-                elif d.subtitle != discsubtitle:
+                if disc.disc_subtitle == None:
+                    disc.disc_subtitle = discsubtitle
+                elif disc.disc_subtitle != discsubtitle:
                     # TODO: Conflict!
-                    self.log.warning(u'Disc subtitle conflict for disc %s: %s != %s' % (disc, disc.subtitle, discsubtitle))
+                    self.log.warning(u'Disc subtitle conflict for disc %s: %s != %s' % (disc, disc.disc_subtitle, discsubtitle))
             if num_tracks != 0:
-                if d.num_tracks == None:
-                    d.num_tracks = num_tracks
-                elif d.num_tracks != num_tracks:
+                if disc.num_tracks == None:
+                    disc.num_tracks = num_tracks
+                elif disc.num_tracks != num_tracks:
                     # TODO: conflict!
                     self.log.warning(u'Disc number of tracks conflict for disc %s: %s != %s' % (disc, disc.num_tracks, num_tracks))
 
@@ -599,9 +885,14 @@ class ImportThread(threading.Thread):
                 self.log.info(u'Could not find disc in database. Created new disc %s' % disc)
                 self.sa_session.add(disc)
 
+        # remember the disc so that the next track on it doesn't have to hit the database
+        if disc != None and album != None and discnumber != 0:
+            self.identity_cache.put(('disc', album, discnumber), disc)
+
         return disc
 
     def stop(self):
         """Cleans up the thread"""
         self.log.info(u'Stop has been called')
         self.running = False
+        import_queue.wake()
@@ -0,0 +1,45 @@
+from musik.util import LRUCache
+
+
+class IdentityCache(object):
+    """A size-bounded, least-recently-used cache of the artists, albums and discs that the
+    importer has already resolved, keyed on the values that the importer searches by.
+    Names and titles are used exactly as they are, so a cache hit finds the same entity that
+    a database query would have.
+    Cached entities are the same objects that live in the importer's session, so entities
+    that were created earlier in the batch but have not been flushed yet are found here
+    even though a database query would not return them.
+    The cache must be cleared whenever the session is rolled back, because any pending
+    entities that it holds will have been discarded.
+    """
+    size = 0            # maximum number of entries
+    entries = None      # LRUCache of the cached entities
+    hits = 0            # number of lookups that were answered from the cache
+    misses = 0          # number of lookups that fell through to the database
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = LRUCache(size)
+
+    def get(self, key):
+        """Returns the entity that is cached under the specified key, or None"""
+        entity = self.entries.get(key)
+        if entity == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entity
+
+    def put(self, key, entity):
+        """Caches the specified entity under the specified key, evicting the least recently
+        used entries if the cache is full."""
+        if entity == None or self.size <= 0:
+            return
+        self.entries.put(key, entity)
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import signal
+
+from musik.importer.mediafile import MediaFile, UnreadableFileError
+
+
+# the MediaFile fields that ImportThread.import_file reads. Only these are copied out of the
+# worker process, which keeps the records small and cheap to pickle.
+FIELDS = [
+    'album', 'albumartist', 'albumartist_sort', 'albumstatus', 'albumtype', 'artist', 'artist_sort',
+    'asin', 'bitdepth', 'bitrate', 'bpm', 'catalognum', 'channels', 'comments', 'comp', 'composer',
+    'country', 'date', 'disc', 'disctitle', 'disctotal', 'encoder', 'format', 'genre', 'label',
+    'language', 'length', 'lyrics', 'mb_albumid', 'mb_artistid', 'mb_releasegroupid', 'mb_trackid',
+    'media', 'samplerate', 'title', 'track', 'year',
+]
+
+
+# number of bytes from the head and the tail of a file that make up its content hash
+HASH_BLOCK_SIZE = 64 * 1024
+
+
+class TrackMetadata(object):
+    """A plain copy of the metadata that MediaFile extracted from a single file.
+    Unlike a MediaFile, it holds no open mutagen objects, so it can be pickled and
+    passed from a worker process back to the import thread. Fields are accessed as
+    attributes, exactly as they would be on a MediaFile.
+    """
+    def __init__(self, uri, fields):
+        self.uri = uri
+        self.__dict__.update(fields)
+
+    def __unicode__(self):
+        return u'<TrackMetadata(uri=%s)>' % self.uri
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def init_worker():
+    """Initializes a metadata worker process.
+    Workers are forked from the main process and inherit its signal handlers, which would
+    cause every worker to try to shut down the whole application on ctrl+c. Only the
+    parent process should respond to those signals.
+    """
+    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, signal.SIG_IGN)
+
+
+def content_hash(uri, size):
+    """Returns a fast hash of the file at the specified uri.
+    Only the size of the file and its first and last HASH_BLOCK_SIZE bytes are hashed.
+    That is enough to notice re-encoded or re-tagged files without reading the whole thing.
+    """
+    hash = hashlib.sha1()
+    hash.update(str(size))
+    with open(uri, 'rb') as f:
+        hash.update(f.read(HASH_BLOCK_SIZE))
+        if size > HASH_BLOCK_SIZE * 2:
+            f.seek(-HASH_BLOCK_SIZE, os.SEEK_END)
+        hash.update(f.read(HASH_BLOCK_SIZE))
+    return hash.hexdigest()
+
+
+def fingerprint(uri, hash_files=False):
+    """Returns a dictionary that contains the file_size, file_mtime and file_hash of the
+    file at the specified uri. file_hash is None unless hash_files is True.
+    These values are compared to the ones stored on a Track to determine whether the file
+    has changed since it was last imported.
+    """
+    stat = os.stat(uri)
+    return {
+        'file_size': stat.st_size,
+        'file_mtime': stat.st_mtime,
+        'file_hash': content_hash(uri, stat.st_size) if hash_files else None,
+    }
+
+
+def read_metadata(uri, hash_files=False):
+    """Reads the tags and fingerprint of the file at the specified uri.
+    Returns a tuple of (uri, metadata, error). If the file could be read, metadata is a
+    TrackMetadata instance and error is None. Otherwise, metadata is None and error
+    describes what went wrong.
+    This function is run in worker processes, so it must remain a module-level function
+    and must never raise - an exception would abort the rest of the batch.
+    """
+    try:
+        media_file = MediaFile(uri)
+        fields = dict((field, getattr(media_file, field)) for field in FIELDS)
+        fields.update(fingerprint(uri, hash_files))
+        return (uri, TrackMetadata(uri, fields), None)
+    except UnreadableFileError as e:
+        return (uri, None, u'Could not extract metadata from %s' % uri)
+    except Exception as e:
+        return (uri, None, u'Unexpected error while reading metadata from %s: %s' % (uri, repr(e)))
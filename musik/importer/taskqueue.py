@@ -0,0 +1,48 @@
+import Queue
+
+
+class ImportQueue(object):
+    """An in-process queue of uris that are waiting to be imported.
+    Anything that creates an ImportTask pushes its uri here once the task has been committed,
+    and ImportThread blocks on the queue instead of polling the import_tasks table. The table
+    is only a journal: it is read once at startup to recover tasks that were queued but not
+    completed before the application stopped.
+    """
+    queue = None
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+
+    def put(self, uri, incremental=False):
+        """Queues the specified uri for import. The ImportTask that records it must already
+        have been committed."""
+        self.queue.put((uri, incremental))
+
+    def get_batch(self, size):
+        """Blocks until at least one uri is queued, then returns a list of up to size
+        (uri, incremental) tuples without waiting for any more to arrive.
+        Returns an empty list if the queue was woken up by a call to wake."""
+        batch = []
+        item = self.queue.get()
+        while item != None:
+            batch.append(item)
+            if len(batch) >= size:
+                break
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        return batch
+
+    def wake(self):
+        """Wakes up the thread that is blocked in get_batch so that it can check whether it
+        should stop"""
+        self.queue.put(None)
+
+    def qsize(self):
+        """Returns the approximate number of uris that are waiting to be imported"""
+        return self.queue.qsize()
+
+
+# there is exactly one import queue per process
+import_queue = ImportQueue()
@@ -0,0 +1,190 @@
+import mimetypes
+import os
+import threading
+import time
+
+from musik import config
+from musik import log
+from musik.db import DatabaseWrapper, ImportTask
+from musik.importer.taskqueue import import_queue
+
+try:
+    # inotify is only available on Linux. Everywhere else, library roots are polled instead.
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+class InotifyBackend(object):
+    """Reports changes to the watched directories as they happen using inotify"""
+    name = 'inotify'
+    watch_manager = None
+    notifier = None
+    changed = None      # uris that have changed since the last call to poll
+
+    def __init__(self, roots):
+        self.changed = []
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager, self.process_event)
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        for root in roots:
+            for (path, descriptor) in self.watch_manager.add_watch(root, mask, rec=True, auto_add=True).iteritems():
+                if descriptor < 0:
+                    raise IOError(u'Failed to watch %s. Try raising fs.inotify.max_user_watches' % path)
+
+    def process_event(self, event):
+        self.changed.append(event.pathname)
+
+    def poll(self, timeout):
+        """Waits up to timeout seconds for file system events and returns the uris that changed"""
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed = self.changed
+        self.changed = []
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+class PollingBackend(object):
+    """Reports changes to the watched directories by periodically walking them and comparing
+    the size and modification time of every audio file to the previous walk."""
+    name = 'polling'
+    roots = None
+    interval = 60       # seconds between walks
+    snapshot = None     # (size, mtime) of every audio file that was found on the last walk, keyed on uri
+    last_walk = 0
+
+    def __init__(self, roots, interval):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self.walk()
+        self.last_walk = time.time()
+
+    def walk(self):
+        snapshot = {}
+        for root in self.roots:
+            for (dirpath, dirnames, filenames) in os.walk(root):
+                for filename in filenames:
+                    uri = os.path.join(dirpath, filename)
+                    if is_audio_file(uri):
+                        try:
+                            stat = os.stat(uri)
+                            snapshot[uri] = (stat.st_size, stat.st_mtime)
+                        except OSError:
+                            pass
+        return snapshot
+
+    def poll(self, timeout):
+        """Waits up to timeout seconds, walking the watched directories if it is time to do
+        so, and returns the uris that changed since the previous walk"""
+        remaining = self.last_walk + self.interval - time.time()
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            return []
+
+        snapshot = self.walk()
+        self.last_walk = time.time()
+        changed = [uri for (uri, fingerprint) in snapshot.iteritems() if self.snapshot.get(uri) != fingerprint]
+        changed.extend(uri for uri in self.snapshot if uri not in snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        self.snapshot = None
+
+
+def is_audio_file(uri):
+    """Returns True if the mimetype of the specified uri indicates that it contains audio data"""
+    (mimetype, encoding) = mimetypes.guess_type(uri)
+    return mimetype is not None and mimetype.startswith('audio')
+
+
+class WatchThread(threading.Thread):
+    """Watches the configured library directories and queues import tasks for the files
+    that are created, modified, moved or deleted in them.
+    Events tend to arrive in bursts - copying an album in produces several events per file -
+    so a uri is only queued once no new events have been seen for it for debounce seconds.
+    """
+    running = True      # whether or not the thread should continue to run
+    sa_session = None   # database session
+    log = None          # logging instance
+    roots = None        # the directories that are being watched
+    debounce = 2.0      # seconds that a uri must be quiet for before it is queued
+    poll_interval = 60  # seconds between walks of the watched directories when inotify is unavailable
+    backend = None      # source of file system events
+    pending = None      # the time that each changed uri last saw an event, keyed on uri
+
+    def __init__(self):
+        """Creates a new instance of WatchThread and connects to the database."""
+        super(WatchThread, self).__init__(name=__name__)
+        db = DatabaseWrapper()
+        self.sa_session = db.get_session()
+        self.log = log.Log(__name__, self.sa_session)
+
+        self.roots = [os.path.abspath(root) for root in config.get('Watcher', 'directories').split(os.pathsep) if root.strip() != '']
+        self.debounce = float(config.get('Watcher', 'debounce'))
+        self.poll_interval = float(config.get('Watcher', 'poll_interval'))
+        self.pending = {}
+
+    def run(self):
+        """Collects file system events and queues the affected uris for import"""
+        try:
+            roots = [root for root in self.roots if os.path.isdir(root)]
+            for root in set(self.roots) - set(roots):
+                self.log.warning(u'Cannot watch %s because it is not a directory' % root)
+
+            if pyinotify != None:
+                try:
+                    self.backend = InotifyBackend(roots)
+                except IOError as e:
+                    self.log.warning(u'%s. Falling back to polling.' % e)
+            if self.backend == None:
+                self.backend = PollingBackend(roots, self.poll_interval)
+            self.log.info(u'Watching %d directories using %s' % (len(roots), self.backend.name))
+
+            while self.running:
+                now = time.time()
+                for uri in self.backend.poll(self.debounce / 2):
+                    self.pending[uri] = now
+                self.queue_quiet_uris()
+        finally:
+            if self.backend != None:
+                self.backend.close()
+                self.backend = None
+            if self.sa_session != None:
+                self.sa_session.close()
+                self.sa_session = None
+
+    def queue_quiet_uris(self):
+        """Queues an import task for every pending uri that hasn't seen an event in the last
+        debounce seconds. Directories that appear are scanned incrementally, files that appear
+        or change are re-read, and uris that disappear cause their tracks to be marked missing."""
+        now = time.time()
+        quiet = [uri for (uri, last_event) in self.pending.iteritems() if now - last_event >= self.debounce]
+        if len(quiet) == 0:
+            return
+
+        tasks = []
+        for uri in quiet:
+            del self.pending[uri]
+            if os.path.isdir(uri):
+                tasks.append(ImportTask(uri, incremental=True))
+            elif is_audio_file(uri) or (not os.path.exists(uri) and mimetypes.guess_type(uri)[0] is None):
+                # the latter case is a directory that was deleted or moved away
+                tasks.append(ImportTask(uri))
+        self.sa_session.add_all(tasks)
+        self.sa_session.commit()
+
+        for task in tasks:
+            import_queue.put(task.uri, task.incremental)
+        if len(tasks) > 0:
+            self.log.info(u'Queued %d changed paths for import' % len(tasks))
+
+    def stop(self):
+        """Cleans up the thread"""
+        self.log.info(u'Stop has been called')
+        self.running = False
@@ -4,7 +4,6 @@ import string
 import time
 
 from musik import config
-from musik.db import DatabaseWrapper, LogEntry
 
 """A logging class that loosely wraps python's built-in logging class in order
 to ensure that log files are always put in the configured directory and named
@@ -12,7 +11,7 @@ appropriately."""
 class Log:
 	log = None
 
-	def __init__(self, module_name, session=None):
+	def __init__(self, module_name, session=None, database=True):
 		"""Creates a logging instance that will write messages to a log file with the specified module_name, as
 		well as to the console. If the messages are of log level WARNING, ERROR, or CRITICAL, they will also be
 		written to the log_entries database table.
@@ -21,6 +20,8 @@ class Log:
 		the entire file on writes, which can block attempts to log to the database if the thread that is calling
 		the log object is using a separate database transaction.
 		Note that if a session is specified, it is the responsibility of the calling class to clean it up.
+		The modules that set up the database schema specify database=False, because the database can't be logged
+		to until the schema is in place.
 		"""
 		# set up logging
 		self.log = logging.getLogger(module_name)
@@ -57,8 +58,12 @@ class Log:
 			self.log.addHandler(fs)
 
 		# create a handler that logs to the database. By default, it logs anything WARNING, ERROR, and CRITICAL
-		sqa = SqlAlchemyLogger(module_name, session)
-		self.log.addHandler(sqa)
+		if database:
+			sqa = SqlAlchemyLogger(module_name, session)
+			self.log.addHandler(sqa)
+		else:
+			# python complains about loggers without handlers, which this one has if the console and files are turned off
+			self.log.addHandler(logging.NullHandler())
 
 
 	def info(self, msg):
@@ -90,6 +95,9 @@ class SqlAlchemyLogger(logging.Handler):
 
 
 	def emit(self, record):
+		# imported here because musik.db imports the schema modules, which log through this module
+		from musik.db import DatabaseWrapper, LogEntry
+
 		responsible_for_session = False
 		if self.session is None:
 			# if a session wasn't specified by the calling object, create one and set a flag that ensures that
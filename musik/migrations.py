@@ -0,0 +1,176 @@
+"""Versioned upgrades for the database schema.
+Base.metadata.create_all can create tables that don't exist yet, but it never changes a table
+that already exists. Every other schema change is shipped as a numbered migration in the
+MIGRATIONS list below. upgrade runs at startup, applies the migrations that the database hasn't
+seen yet in order, each in its own transaction, and records them in the schema_versions table.
+Fresh databases are created from the current schema and stamped with the latest version.
+
+To add a migration, append a (version, description, function) tuple to MIGRATIONS. The function
+is called with a connection that is inside a transaction and with the application's metadata,
+and it should tolerate being run against a database that already partially matches the new
+schema.
+"""
+
+from contextlib import contextmanager
+import datetime
+
+from musik import aggregates
+from musik import log
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import Column
+from sqlalchemy.types import BigInteger, Boolean, Float, Integer, String
+
+
+# the log_entries table may not exist yet, so messages only go to the console and log files
+log = log.Log(__name__, database=False)
+
+
+@contextmanager
+def schema_connection(engine):
+    """Yields a connection on which a transaction also covers schema changes.
+    pysqlite commits implicitly before DDL statements and defers BEGIN until the first write,
+    which would make migrations non-transactional and savepoints unusable, so its transaction
+    handling is switched off for this one connection and each transaction begins explicitly.
+    Everywhere else it is left on. Under WAL, a transaction that begins explicitly, reads, and
+    then writes fails straight away if another connection committed in between, whatever
+    busy_timeout says, while one that only begins at its first write waits its turn."""
+    with engine.connect() as connection:
+        if engine.dialect.name != 'sqlite':
+            yield connection
+            return
+
+        dbapi_connection = connection.connection.connection
+        dbapi_connection.isolation_level = None
+        event.listen(connection, 'begin', _begin_sqlite_transaction)
+        try:
+            yield connection
+        finally:
+            # the connection goes back to the pool afterwards
+            dbapi_connection.isolation_level = ''
+
+
+def _begin_sqlite_transaction(connection):
+    connection.execute('BEGIN')
+
+
+def _add_column(connection, table_name, column):
+    """Adds the specified column to the specified table unless it already exists"""
+    existing = set(c['name'] for c in inspect(connection).get_columns(table_name))
+    if column.name not in existing:
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, column.name, column_type))
+
+
+def create_missing_indexes(connection, metadata):
+    """Creates any indexes that are declared on the schema but missing from the database"""
+    inspector = inspect(connection)
+    for table in metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for index in table.indexes:
+            # indexes on columns that a later migration adds are created by that migration
+            if index.name not in existing and all(column.name in columns for column in index.columns):
+                # a failed statement aborts the whole transaction on some databases, such as
+                # PostgreSQL, so each index is created in a savepoint that can be rolled back alone
+                savepoint = connection.begin_nested()
+                try:
+                    index.create(connection)
+                    savepoint.commit()
+                except IntegrityError:
+                    # existing rows violate a unique index. Leave it out rather than refusing to start
+                    savepoint.rollback()
+                    log.warning(u'Could not create unique index %s because %s contains duplicate values' % (index.name, table.name))
+
+
+def _add_fingerprint_columns(connection, metadata):
+    _add_column(connection, 'tracks', Column('file_size', BigInteger))
+    _add_column(connection, 'tracks', Column('file_mtime', Float))
+    _add_column(connection, 'tracks', Column('file_hash', String))
+    _add_column(connection, 'tracks', Column('missing', Boolean))
+    _add_column(connection, 'import_tasks', Column('incremental', Boolean))
+
+
+def _create_lookup_indexes(connection, metadata):
+    create_missing_indexes(connection, metadata)
+
+
+def _add_aggregate_columns(connection, metadata):
+    _add_column(connection, 'albums', Column('track_count', Integer))
+    _add_column(connection, 'albums', Column('length', BigInteger))
+    _add_column(connection, 'artists', Column('album_count', Integer))
+    _add_column(connection, 'artists', Column('track_count', Integer))
+    _add_column(connection, 'artists', Column('length', BigInteger))
+    aggregates.repair(connection)
+    create_missing_indexes(connection, metadata)
+
+
+MIGRATIONS = [
+    (1, u'Add file fingerprint columns to tracks and the incremental flag to import tasks', _add_fingerprint_columns),
+    (2, u'Index the columns that the importer and API look up and sort by', _create_lookup_indexes),
+    (3, u'Index albums by artist for counting', _create_lookup_indexes),
+    (4, u'Index tracks by artist and genre for random selection', _create_lookup_indexes),
+    (5, u'Store the track counts, album counts and lengths of albums and artists', _add_aggregate_columns),
+]
+
+
+def latest_version():
+    """Returns the schema version that this version of the application expects"""
+    return MIGRATIONS[-1][0]
+
+
+def current_version(connection, metadata):
+    """Returns the version of the schema that the database is at"""
+    versions = metadata.tables['schema_versions']
+    version = connection.execute(versions.select().order_by(versions.c.version.desc()).limit(1)).first()
+    return 0 if version is None else version.version
+
+
+def _record_version(connection, metadata, version, description):
+    versions = metadata.tables['schema_versions']
+    connection.execute(versions.insert(), version=version, description=description, applied=datetime.datetime.utcnow())
+
+
+def upgrade(engine, metadata):
+    """Brings the database schema up to date.
+    Returns the list of migration versions that were applied.
+    """
+    is_new_database = 'tracks' not in inspect(engine).get_table_names()
+
+    # creates any tables that don't exist yet, including schema_versions
+    metadata.create_all(engine)
+
+    if is_new_database:
+        # the tables that were just created already match the latest schema
+        with schema_connection(engine) as connection:
+            with connection.begin():
+                _record_version(connection, metadata, latest_version(), u'Created new database')
+        return []
+
+    applied = []
+    with schema_connection(engine) as connection:
+        version = current_version(connection, metadata)
+        for (migration_version, description, migration) in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            log.info(u'Upgrading database schema to version %d: %s' % (migration_version, description))
+            with connection.begin():
+                migration(connection, metadata)
+                _record_version(connection, metadata, migration_version, description)
+            applied.append(migration_version)
+
+    # the query planner needs fresh statistics after the shape of the database changes
+    if len(applied) > 0:
+        optimize(engine)
+    return applied
+
+
+def optimize(engine, reindex=False):
+    """Refreshes the statistics that the query planner uses to choose indexes. This should be
+    called after bulk changes to the library. If reindex is True, every index is rebuilt first,
+    which compacts indexes that have become fragmented by many inserts and deletes."""
+    with engine.connect() as connection:
+        if reindex and engine.dialect.name == 'sqlite':
+            connection.execute('REINDEX')
+        connection.execute('ANALYZE')
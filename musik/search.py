@@ -0,0 +1,165 @@
+"""Full-text search over the tracks in the library.
+On SQLite builds that include FTS5, every track has a row in the search_index virtual table that
+holds its title, artist, album, genre and lyrics. The importer updates those rows in the same
+transaction that changes the tracks, and queries are answered from the inverted index and ranked
+with bm25. Other databases, and SQLite builds without FTS5, fall back to LIKE queries, which
+work but have to scan the tracks table.
+"""
+
+import re
+
+from musik import log
+from musik.migrations import schema_connection
+from musik.util import uri_chunks
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import text
+
+
+TABLE = 'search_index'
+
+# indexed columns and how much a match in each of them counts towards the rank of a track
+COLUMNS = [
+    ('title', 10.0),
+    ('artist', 5.0),
+    ('album', 5.0),
+    ('genre', 2.0),
+    ('lyrics', 1.0),
+]
+
+# the document that is indexed for each track
+DOCUMENTS = '''
+    SELECT tracks.id, tracks.title, artists.name, albums.title, tracks.genre, tracks.lyrics
+    FROM tracks
+    LEFT OUTER JOIN artists ON artists.id = tracks.artist_id
+    LEFT OUTER JOIN albums ON albums.id = tracks.album_id
+'''
+
+# broad queries are answered a tier at a time instead of being ranked with bm25: first the tracks
+# whose titles match, then those that match on title, artist and album, and so on
+TIERS = [
+    ['title'],
+    ['title', 'artist', 'album'],
+    ['title', 'artist', 'album', 'genre'],
+    [name for (name, weight) in COLUMNS],
+]
+
+# queries that match more tracks than this are answered by tier. bm25 has to score every match
+# before it can return the best ones, which takes hundreds of milliseconds for a short prefix
+# that matches most of a large library.
+RANK_LIMIT = 1000
+
+# whether the full-text index is available, keyed on database url
+_available = {}
+
+# the index is set up along with the schema, before the log_entries table can be written to
+log = log.Log(__name__, database=False)
+
+
+def init_index(engine):
+    """Creates the full-text index if the database supports it and it doesn't exist yet, and
+    fills it from the tracks that are already in the library. Called once per process when the
+    database is initialized."""
+    available = False
+    if engine.dialect.name == 'sqlite':
+        # the table is created and filled in the same transaction, so an interrupted rebuild
+        # doesn't leave an empty index behind
+        with schema_connection(engine) as connection, connection.begin():
+            exists = connection.execute(text('SELECT count(*) FROM sqlite_master WHERE name = :name'), name=TABLE).scalar() > 0
+            if not exists:
+                try:
+                    # the prefix option keeps extra index entries for the first two and three
+                    # characters of every token so that short prefix queries don't have to scan
+                    connection.execute('CREATE VIRTUAL TABLE %s USING fts5(%s, tokenize=\'unicode61 remove_diacritics 1\', prefix=\'2 3\')'
+                                       % (TABLE, ', '.join(name for (name, weight) in COLUMNS)))
+                    log.info(u'Building the full-text search index')
+                    rebuild(connection)
+                    exists = True
+                except OperationalError:
+                    # this build of SQLite doesn't include FTS5
+                    log.warning(u'SQLite was built without FTS5. Searches will be slow.')
+            available = exists
+    _available[str(engine.url)] = available
+    return available
+
+
+def is_available(connection):
+    """Returns True if searches on the specified connection's database use the full-text index"""
+    return _available.get(str(connection.engine.url), False)
+
+
+def rebuild(connection):
+    """Replaces the contents of the full-text index with the current contents of the library"""
+    connection.execute('DELETE FROM %s' % TABLE)
+    connection.execute('INSERT INTO %s (rowid, %s) %s' % (TABLE, ', '.join(name for (name, weight) in COLUMNS), DOCUMENTS))
+
+
+def index_tracks(connection, uris):
+    """Updates the full-text index entries of the tracks at the specified uris.
+    This should be called with the connection of the session that changed the tracks, after it
+    has been flushed, so that the index is committed along with them."""
+    if not is_available(connection):
+        return
+
+    for (selected, params) in uri_chunks(uris):
+        connection.execute(text('DELETE FROM %s WHERE rowid IN (SELECT tracks.id FROM tracks WHERE %s)' % (TABLE, selected)), **params)
+        connection.execute(text('INSERT INTO %s (rowid, %s) %s WHERE %s'
+                                % (TABLE, ', '.join(name for (name, weight) in COLUMNS), DOCUMENTS, selected)), **params)
+
+
+def optimize(connection):
+    """Merges the segments of the full-text index so that queries read fewer pages"""
+    if is_available(connection):
+        connection.execute(text('INSERT INTO %s (%s) VALUES (\'optimize\')' % (TABLE, TABLE)))
+
+
+def tokenize(query):
+    """Splits a search query into the words that it contains"""
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+def search(connection, query, limit):
+    """Returns the ids of up to limit tracks that match every word of the specified query, best
+    match first. Words are matched against the title, artist, album, genre and lyrics of each
+    track. The last word matches any word that it is a prefix of, so that results can be shown
+    while the user is still typing it."""
+    words = tokenize(query)
+    if len(words) == 0:
+        return []
+
+    if is_available(connection):
+        # quoting each word keeps FTS5 from interpreting it as an operator or a column name.
+        # Only the last word is a prefix query: a prefix has to merge the entries of every word
+        # that it expands to, whereas a whole word can skip straight to the tracks that contain
+        # the other words.
+        match = u' '.join([u'"%s"' % word for word in words[:-1]] + [u'"%s"*' % words[-1]])
+
+        matches = text('SELECT rowid FROM %s WHERE %s MATCH :match LIMIT 1 OFFSET :offset' % (TABLE, TABLE))
+        if connection.execute(matches, match=match, offset=RANK_LIMIT).first() == None:
+            ranked = text('SELECT rowid FROM %s WHERE %s MATCH :match ORDER BY bm25(%s, %s) LIMIT :limit'
+                          % (TABLE, TABLE, TABLE, ', '.join(str(weight) for (name, weight) in COLUMNS)))
+            return [row[0] for row in connection.execute(ranked, match=match, limit=limit)]
+
+        # each tier only has to read its first few matches, however many there are
+        ids = []
+        for columns in TIERS:
+            tier = text('SELECT rowid FROM %s WHERE %s MATCH :match LIMIT :limit' % (TABLE, TABLE))
+            found = set(ids)
+            for row in connection.execute(tier, match=u'{%s} : (%s)' % (' '.join(columns), match), limit=limit + len(ids)):
+                if row[0] not in found:
+                    ids.append(row[0])
+            if len(ids) >= limit:
+                break
+        return ids[:limit]
+
+    # without an index, every word has to appear somewhere in one of the searched columns
+    conditions = []
+    params = {'limit': limit}
+    for (i, word) in enumerate(words):
+        params['word%d' % i] = u'%' + word + u'%'
+        conditions.append('(tracks.title LIKE :word%d OR artists.name LIKE :word%d OR albums.title LIKE :word%d OR tracks.genre LIKE :word%d)' % (i, i, i, i))
+    unranked = text('SELECT tracks.id FROM tracks '
+                    'LEFT OUTER JOIN artists ON artists.id = tracks.artist_id '
+                    'LEFT OUTER JOIN albums ON albums.id = tracks.album_id '
+                    'WHERE %s ORDER BY tracks.title LIMIT :limit' % ' AND '.join(conditions))
+    return [row[0] for row in connection.execute(unranked, **params)]
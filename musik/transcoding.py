@@ -0,0 +1,284 @@
+"""The transcoding machinery that is shared by every stream, the policy that chooses the bitrate
+of each stream, and a thread that fills the transcode cache ahead of time.
+The most popular tracks are requested over and over in the same few formats, mostly mp3 for
+mobile clients and ogg for browsers. PretranscodeThread transcodes them into those formats during
+the quiet hours of the night, so that they are served from the transcode cache at busy times
+instead of each starting its own encoder. It uses a pipeline slot like any other transcode, only
+runs while the machine is otherwise idle, reads its output at a limited rate so that the encoder
+can't saturate the disks or processors, and gives way as soon as a listener has to wait for a
+pipeline.
+"""
+
+import datetime
+import multiprocessing
+import os
+import threading
+import time
+
+from sqlalchemy import func, or_
+
+from musik import audiotranscode
+from musik import config
+from musik import log
+from musik.audiotranscode.cache import TranscodeCache
+from musik.audiotranscode.scheduler import SchedulerBusy, TranscodeScheduler
+from musik.db import DatabaseWrapper, Track, UserAction
+from musik.util import LRUCache
+
+
+# the encoders and decoders that are installed are only looked for once
+transcoder = audiotranscode.AudioTranscode()
+
+# transcoded streams are kept on disk so that each track only has to be encoded once per format
+transcode_cache = TranscodeCache(config.get('Transcoding', 'cache_directory'), int(config.get('Transcoding', 'cache_size')) * 1024 * 1024)
+
+# every transcode runs a decoder and an encoder process, so only a few of them are allowed at once
+transcode_scheduler = TranscodeScheduler(int(config.get('Transcoding', 'max_pipelines')),
+                                         int(config.get('Transcoding', 'max_pipelines_per_client')),
+                                         int(config.get('Transcoding', 'max_queue')),
+                                         float(config.get('Transcoding', 'max_queue_wait')))
+
+
+class BitratePolicy(object):
+    """Lowers the bitrate of transcoded streams when the server or the client can't keep up.
+    While every pipeline is in use, new transcodes are encoded at no more than busy_bitrate, which
+    takes less encoder time and bandwidth. Clients whose connections turn out to be slow get a
+    bitrate that fits within what they were measured at, with some headroom.
+    A client's throughput is measured near the start of each transcoded stream that it reads, as
+    the number of bytes sent divided by the time spent sending them. The first warmup_size bytes
+    are left out because they mostly just fill the socket's buffers. Players download as fast as
+    they can until their own buffers are full, so the next measure_size bytes are limited by the
+    connection rather than by the speed of playback.
+    """
+    enabled = False         # whether bitrates are lowered at all
+    busy_bitrate = 96       # highest bitrate in kbps of new transcodes while the scheduler is saturated
+    min_bitrate = 64        # bitrate in kbps that slow clients are never pushed below
+    headroom = 1.5          # a client's throughput has to be this many times the bitrate of its streams
+    warmup_size = 262144    # bytes at the start of a stream that aren't measured
+    measure_size = 1048576  # bytes after the warmup that a client's throughput is measured over
+    max_clients = 1000      # number of clients whose throughput is remembered
+    throughput = None       # LRUCache of the most recently measured throughput in kbps, keyed on client
+    lock = None             # throughput is measured by several streaming threads at once
+
+    def __init__(self, enabled, busy_bitrate, min_bitrate):
+        self.enabled = enabled
+        self.busy_bitrate = busy_bitrate
+        self.min_bitrate = min_bitrate
+        self.throughput = LRUCache(self.max_clients)
+        self.lock = threading.Lock()
+
+    def for_client(self, client, audio_format, bitrate):
+        """Returns the bitrate that the specified client should get in place of the one that it
+        asked for, given how fast its connection is"""
+        if not self.enabled or audio_format in audiotranscode.LOSSLESS:
+            return bitrate
+        with self.lock:
+            throughput = self.throughput.get(client)
+        if throughput == None or throughput >= bitrate * self.headroom:
+            return bitrate
+        return min(bitrate, max(audiotranscode.bitrate_step(throughput / self.headroom), self.min_bitrate))
+
+    def for_load(self, audio_format, bitrate):
+        """Returns the bitrate that a new transcode should be encoded at in place of the specified
+        one, given how busy the transcode scheduler is"""
+        if not self.enabled or audio_format in audiotranscode.LOSSLESS:
+            return bitrate
+        if transcode_scheduler.is_saturated():
+            return min(bitrate, self.busy_bitrate)
+        return bitrate
+
+    def measure(self, client, chunks):
+        """Yields each of the chunks of a stream that is being sent to the specified client, and
+        measures the client's throughput from the time that it takes to send them"""
+        sent = 0
+        measured = 0
+        sending = 0.0
+        for data in chunks:
+            started = time.time()
+            yield data
+            sent += len(data)
+            if sent > self.warmup_size and measured < self.measure_size:
+                measured += len(data)
+                sending += time.time() - started
+                if measured >= self.measure_size and sending > 0:
+                    self.record(client, measured * 8 / 1000.0 / sending)
+
+    def record(self, client, throughput):
+        """Remembers the throughput in kbps that was measured for the specified client"""
+        with self.lock:
+            self.throughput.put(client, throughput)
+
+
+bitrate_policy = BitratePolicy(config.get('Transcoding', 'adaptive_bitrate') == 'true',
+                               int(config.get('Transcoding', 'busy_bitrate')),
+                               int(config.get('Transcoding', 'min_bitrate')))
+
+
+class PretranscodeThread(threading.Thread):
+    """Transcodes the most played tracks into the configured formats between start_hour and
+    end_hour, local time, once a night. A track's popularity is its playcount plus the number of
+    times that a user started it."""
+    running = True      # whether or not the thread should continue to run
+    sa_session = None   # database session
+    log = None          # logging instance
+    formats = None      # formats to transcode into, in order of preference
+    track_count = 100   # number of the most played tracks to transcode
+    start_hour = 2      # hour of the day at which pre-transcoding may start
+    end_hour = 6        # hour of the day at which pre-transcoding stops
+    max_load = 0.5      # pre-transcoding pauses while the load average per processor is higher than this
+    max_rate = 1024     # kilobytes of output per second that each transcode is read at
+    cache_share = 0.75  # pre-transcoding stops once the transcode cache is this full, to leave room for other tracks
+
+    client = 'pretranscode'     # the name that the thread's transcodes are scheduled under
+
+    def __init__(self):
+        """Creates a new instance of PretranscodeThread and connects to the database."""
+        super(PretranscodeThread, self).__init__(name=__name__)
+        self.sa_session = DatabaseWrapper().get_session()
+        self.log = log.Log(__name__, self.sa_session)
+
+        self.formats = [f.strip() for f in config.get('Pretranscode', 'formats').split(',') if f.strip() != '']
+        self.track_count = int(config.get('Pretranscode', 'track_count'))
+        self.start_hour = int(config.get('Pretranscode', 'start_hour'))
+        self.end_hour = int(config.get('Pretranscode', 'end_hour'))
+        self.max_load = float(config.get('Pretranscode', 'max_load'))
+        self.max_rate = float(config.get('Pretranscode', 'max_rate'))
+
+    def run(self):
+        """Waits for the quiet hours, transcodes the most popular tracks, and then waits for the
+        quiet hours to end so that the tracks are only transcoded once a night"""
+        try:
+            while self.running:
+                if not self.is_quiet_time():
+                    self.wait(60)
+                    continue
+
+                self.log.info(u'Pre-transcoding the %d most played tracks into %s' % (self.track_count, ', '.join(self.formats)))
+                count = self.transcode_popular_tracks()
+                self.log.info(u'Pre-transcoded %d tracks' % count)
+
+                while self.running and self.is_quiet_time():
+                    self.wait(60)
+        finally:
+            if self.sa_session != None:
+                self.sa_session.close()
+                self.sa_session = None
+
+    def is_quiet_time(self):
+        """Returns True if the current hour is between start_hour and end_hour, which may wrap
+        around midnight"""
+        hour = datetime.datetime.now().hour
+        if self.start_hour <= self.end_hour:
+            return self.start_hour <= hour < self.end_hour
+        return hour >= self.start_hour or hour < self.end_hour
+
+    def is_busy(self):
+        """Returns True if the machine or the transcode scheduler has better things to do"""
+        return transcode_scheduler.stats()['queued'] > 0 or self.is_loaded()
+
+    def is_loaded(self):
+        """Returns True if the load average per processor is higher than max_load"""
+        if not hasattr(os, 'getloadavg'):
+            # the load average isn't available on Windows
+            return False
+        return os.getloadavg()[0] / multiprocessing.cpu_count() > self.max_load
+
+    def wait(self, seconds):
+        """Sleeps for the specified number of seconds, or until the thread is stopped"""
+        end = time.time() + seconds
+        while self.running and time.time() < end:
+            time.sleep(min(1, end - time.time()))
+
+    def popular_tracks(self):
+        """Returns the id, uri and mimetype of the track_count most played tracks"""
+        plays = self.sa_session.query(UserAction.trackId.label('track_id'), func.count(UserAction.id).label('plays')) \
+            .filter(UserAction.actionType == 'START_TRACK').group_by(UserAction.trackId).subquery()
+        popularity = func.coalesce(Track.playcount, 0) + func.coalesce(plays.c.plays, 0)
+        query = self.sa_session.query(Track.id, Track.uri, Track.mimetype) \
+            .outerjoin(plays, plays.c.track_id == Track.id) \
+            .filter(or_(Track.missing == None, Track.missing == False)) \
+            .filter(popularity > 0).order_by(popularity.desc(), Track.id).limit(self.track_count)
+        tracks = query.all()
+
+        # the transaction would otherwise stay open for the rest of the night
+        self.sa_session.rollback()
+        return tracks
+
+    def transcode_popular_tracks(self):
+        """Transcodes each of the most played tracks that isn't in the transcode cache yet into
+        each of the formats. Returns the number of transcodes that were added to the cache."""
+        if transcode_cache.max_size <= 0:
+            self.log.warning(u'Cannot pre-transcode because the transcode cache is turned off')
+            return 0
+
+        formats = [f for f in self.formats if f in transcoder.available_encoder_formats()]
+        for f in set(self.formats) - set(formats):
+            self.log.warning(u'Cannot pre-transcode into %s because no encoder is available' % f)
+
+        count = 0
+        for track in self.popular_tracks():
+            for audio_format in formats:
+                # the cache can't keep everything, and on-demand transcodes need room too
+                if transcode_cache.size >= transcode_cache.max_size * self.cache_share:
+                    self.log.info(u'Stopped pre-transcoding because the transcode cache is full')
+                    return count
+                if not self.running or not self.is_quiet_time():
+                    return count
+                if audiotranscode.mime_type(audio_format) == track.mimetype:
+                    continue
+                if self.transcode(track, audio_format):
+                    count += 1
+        return count
+
+    def transcode(self, track, audio_format):
+        """Transcodes a track into the transcode cache, unless it is already there, at no more
+        than max_rate, pausing whenever the machine is busy. Gives up if a listener is waiting
+        for a pipeline. Returns True if the track was added to the cache."""
+        bitrate = audiotranscode.default_bitrate(audio_format)
+        try:
+            path = transcode_cache.path(track.id, os.path.getmtime(track.uri), audio_format, bitrate)
+        except OSError:
+            return False
+        if os.path.exists(path):
+            return False
+
+        while self.running and self.is_busy():
+            self.wait(10)
+        try:
+            slot = transcode_scheduler.acquire(self.client)
+        except SchedulerBusy:
+            return False
+
+        stream = None
+        try:
+            stream = transcode_cache.record(path, transcoder.transcode_stream(track.uri, audio_format, bitrate))
+            started = time.time()
+            size = 0
+            for data in stream:
+                if not self.running or transcode_scheduler.stats()['queued'] > 0:
+                    return False
+
+                # reading slowly holds the encoder back, because it blocks when the pipe is full
+                size += len(data)
+                delay = size / (self.max_rate * 1024.0) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                if self.is_loaded():
+                    while self.running and self.is_loaded():
+                        time.sleep(1)
+                    # the pause doesn't count towards the rate
+                    started = time.time()
+                    size = 0
+            return os.path.exists(path)
+        except audiotranscode.TranscodeError as e:
+            self.log.warning(u'Failed to pre-transcode %s into %s: %s' % (track.uri, audio_format, e))
+            return False
+        finally:
+            if stream != None:
+                stream.close()
+            slot.release()
+
+    def stop(self):
+        """Cleans up the thread"""
+        self.log.info(u'Stop has been called')
+        self.running = False
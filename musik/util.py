@@ -1,6 +1,12 @@
+from collections import OrderedDict
 import datetime
 import json
 
+
+# number of values that are bound per statement by statements that are run a chunk at a time.
+# SQLite before 3.32 allows at most 999 variables in a statement.
+CHUNK_SIZE = 500
+
 class EasygoingDictionary(dict):
 	"""A dictionary that returns None if you try to access a non-existent key.
 	"""
@@ -22,4 +28,69 @@ class DateTimeEncoder(json.JSONEncoder):
 		elif isinstance(obj, datetime.timedelta):
 			return (datetime.datetime.min + obj).time().isoformat()
 		else:
-			return json.JSONEncoder.default(self, obj)
\ No newline at end of file
+			return json.JSONEncoder.default(self, obj)
+
+
+class LRUCache(object):
+	"""A dictionary that keeps track of the order in which its entries were used, and evicts the
+	least recently used ones whenever their total weight exceeds max_weight. Each entry weighs 1
+	unless a weigh function is specified, which is called with a value and returns its weight.
+	It isn't thread-safe. Callers that share one between threads have to lock it themselves.
+	"""
+	max_weight = 0		# maximum total weight of the entries
+	weight = 0			# total weight of the entries
+	weigh = None		# returns the weight of a value
+	entries = None		# ordered from least to most recently used
+
+	def __init__(self, max_weight, weigh=None):
+		self.max_weight = max_weight
+		self.weigh = weigh if weigh != None else (lambda value: 1)
+		self.entries = OrderedDict()
+
+	def get(self, key):
+		"""Returns the value that is stored under the specified key and marks it as the most
+		recently used, or returns None"""
+		value = self.entries.pop(key, None)
+		if value != None:
+			self.entries[key] = value
+		return value
+
+	def put(self, key, value):
+		"""Stores the specified value under the specified key as the most recently used entry,
+		and evicts the least recently used entries until the rest fit within max_weight"""
+		self.pop(key)
+		self.entries[key] = value
+		self.weight += self.weigh(value)
+		while self.weight > self.max_weight and len(self.entries) > 0:
+			(evicted_key, evicted_value) = self.entries.popitem(last=False)
+			self.weight -= self.weigh(evicted_value)
+
+	def pop(self, key):
+		"""Removes the entry that is stored under the specified key and returns its value, or
+		returns None"""
+		value = self.entries.pop(key, None)
+		if value != None:
+			self.weight -= self.weigh(value)
+		return value
+
+	def clear(self):
+		"""Removes every entry"""
+		self.entries.clear()
+		self.weight = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+
+def chunks(values, size=CHUNK_SIZE):
+	"""Yields consecutive slices of the specified list that hold at most size values each"""
+	for index in range(0, len(values), size):
+		yield values[index:index + size]
+
+
+def uri_chunks(uris):
+	"""Yields a (condition, params) tuple for each chunk of the specified track uris, for use in
+	text() statements. condition is a tracks.uri IN (...) clause, and params binds its values."""
+	for chunk in chunks(uris):
+		names = ['uri%d' % i for i in range(len(chunk))]
+		yield ('tracks.uri IN (%s)' % ', '.join(':%s' % name for name in names), dict(zip(names, chunk)))
@@ -108,7 +108,11 @@ class WebService(object):
                 # anybody can request a list of the available encoders or stream any song file
                 # TODO: this could be considered a security hole. See https://github.com/MusikPolice/musik/issues/54
                 'tools.authorize.on': False,
-            }
+            },
+            '/stream/capabilities': {
+                # refreshing the encoders and decoders is up to users who have logged in
+                'tools.authorize.on': True,
+            },
         }
 
         cherrypy.tree.mount(application.Musik(), '/', config=app_config)
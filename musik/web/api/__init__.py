@@ -10,6 +10,7 @@ class API():
     artist = library.Artist()
     artists = library.Artists()
     discs = library.Discs()
+    search = library.Search()
     tracks = library.Tracks()
     stream = streaming.Track()
     importer = importmedia.Importer()
@@ -1,5 +1,6 @@
 from musik import log
-from musik.db import ImportTask, LogEntry
+from musik.db import DatabaseWrapper, ImportTask, LogEntry
+from musik.importer.taskqueue import import_queue
 from musik.util import DateTimeEncoder
 
 import cherrypy
@@ -16,17 +17,32 @@ class Importer():
 
     def POST(self):
         """Queues the specified path for import into the media library.
+        If the request body sets incremental to true, files that haven't changed since
+        they were last imported are skipped, and files that have disappeared from the
+        path are marked as missing.
+        If the request body sets repair_aggregates to true instead, the track counts, album
+        counts and lengths of every album and artist are recomputed.
         """
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
+        body = json.loads(cherrypy.request.body.read())
+        if body.get('repair_aggregates', False):
+            DatabaseWrapper().repair_aggregates()
+            return json.dumps(None)
+
         # get the path from the request and make sure that it exists on the local machine
-        path = json.loads(cherrypy.request.body.read())['path']
+        path = body['path']
         if not path or not os.path.isdir(path):
             raise cherrypy.HTTPError("404 Not Found", "Couldn't find the path " + str(path) + " on the target system")
 
-        task = ImportTask(path)
+        incremental = bool(body.get('incremental', False))
+        task = ImportTask(path, incremental=incremental)
         cherrypy.request.db.add(task)
 
+        # the task has to be in the journal before the import thread can pick it up
+        cherrypy.request.db.commit()
+        import_queue.put(path, incremental)
+
         # this is an http 200 ok with no data
         return json.dumps(None)
 
@@ -1,18 +1,87 @@
 from musik import log
+from musik import search
 
 import cherrypy
-from musik.db import Album, Artist, Disc, Track
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import joinedload, subqueryload
+from sqlalchemy.types import String
+from musik.db import Album, Artist, DatabaseWrapper, Disc, Track, library_generation
 import musik.web.api.library
-from musik.util import DateTimeEncoder
+from musik.web.cache import cached, response_cache
+from musik.util import DateTimeEncoder, LRUCache
 
+from array import array
+import base64
 import json
 import random
-
-
-def _query(obj, sortby, params, ignored):
-    """Performs a generic database query and returns the results as a dictionary.
-    obj: The musik.db object to query (Track, Artist, Album, etc)
-    sortby: The field of obj to sort the results by (Track.title, Artist.name, etc)
+import threading
+
+
+# number of rows that streaming responses read from the database at a time
+STREAM_BATCH_SIZE = 100
+
+# number of search results that are returned if the client doesn't ask for a specific number
+SEARCH_DEFAULT_LIMIT = 50
+
+# maximum number of search results that a client can ask for
+SEARCH_MAX_LIMIT = 500
+
+# maximum number of tracks that a client can ask for from /api/tracks/random at a time
+RANDOM_MAX_COUNT = 100
+
+# number of shuffled track orders that are kept in memory. Each one holds an id for every track
+# that it can choose from.
+SHUFFLE_CACHE_SIZE = 8
+
+# number of tracks that are returned per page of /api/tracks/shuffle by default
+SHUFFLE_DEFAULT_LIMIT = 50
+
+# loader options that fetch everything that as_dict reads for each type of result up front, in
+# a fixed number of queries, instead of lazily loading the relationships of every row one by one.
+# Counts are stored on the albums and artists themselves.
+ARTISTS_OPTIONS = []
+
+ARTIST_OPTIONS = [
+    subqueryload('albums'),
+]
+
+ALBUMS_OPTIONS = [
+    joinedload('artist'),
+    subqueryload('discs'),
+]
+
+ALBUM_OPTIONS = ALBUMS_OPTIONS + [
+    subqueryload('tracks'),
+]
+
+TRACKS_OPTIONS = [
+    joinedload('album'),
+    joinedload('album.artist'),
+    subqueryload('album.discs'),
+    subqueryload('album.tracks'),
+    joinedload('artist'),
+    joinedload('album_artist'),
+    joinedload('disc'),
+]
+
+SEARCH_OPTIONS = [
+    joinedload('album'),
+    joinedload('artist'),
+]
+
+DISCS_OPTIONS = [
+    joinedload('album'),
+    joinedload('album.artist'),
+    subqueryload('album.discs'),
+    subqueryload('album.tracks'),
+    subqueryload('tracks'),
+    joinedload('tracks.artist'),
+    joinedload('tracks.album_artist'),
+]
+
+
+def _filter(obj, params):
+    """Returns a query for the objects of type obj that match the specified params.
     params: A list of key/value pairs to query with, where key is the database obj
             field and value is the value to search for. Strings will be matched with
             a LIKE clause, other values are matched with strict equality.
@@ -33,21 +102,319 @@ def _query(obj, sortby, params, ignored):
         key = d.keys()[0]
         value = d[key]
 
-        if str(fields[key].type) == 'VARCHAR':
+        if isinstance(fields[key].type, String):
             # allow for partial string matching
             q = q.filter(fields[key].like('%' + value + '%'))
         else:
             # all other data types must be exact matches
             q = q.filter(fields[key] == value)
 
+    return q
+
+
+def _cursor_key(row, sortby):
+    """Returns the (sort_value, id) tuple that identifies the position of row in a result set
+    that is sorted by sortby"""
+    return (getattr(row, sortby.key), row.id)
+
+
+def _encode_cursor(sort_value, id):
+    """Returns an opaque cursor that identifies the position of a row in a sorted result set"""
+    return base64.urlsafe_b64encode(json.dumps([sort_value, id]))
+
+
+def _decode_cursor(cursor):
+    """Returns the (sort_value, id) tuple that was encoded in the specified cursor"""
+    try:
+        (sort_value, id) = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return (sort_value, int(id))
+    except (TypeError, ValueError):
+        raise cherrypy.HTTPError(400, 'Invalid cursor specified: %s' % cursor)
+
+
+def _after(q, obj, sortby, sort_value, id, descending=False):
+    """Filters q to the rows that sort after the row identified by sort_value and id.
+    The conditions are written so that the database can seek straight to the cursor using the
+    index on sortby, rather than sorting the whole table for every page."""
+    if sortby is obj.id:
+        return q.filter(obj.id < id if descending else obj.id > id)
+
+    # NULLs sort before everything else in SQLite and MySQL, and after everything else in
+    # PostgreSQL and Oracle. A descending sort reverses the whole order, NULLs included.
+    nulls_last = (q.session.get_bind(obj).dialect.name in ['postgresql', 'oracle']) != descending
+    if sort_value == None:
+        after = and_(sortby == None, obj.id < id if descending else obj.id > id)
+        if not nulls_last:
+            after = or_(after, sortby != None)
+    elif descending:
+        after = and_(sortby <= sort_value, or_(sortby < sort_value, obj.id < id))
+    else:
+        after = and_(sortby >= sort_value, or_(sortby > sort_value, obj.id > id))
+    if sort_value != None and nulls_last:
+        after = or_(after, sortby == None)
+    return q.filter(after)
+
+
+def _order(q, obj, sortby, descending=False):
+    """Orders q by sortby. Rows that sort equally are ordered by id, so the order of the results
+    is stable and every row appears on exactly one page."""
+    if sortby is obj.id:
+        return q.order_by(obj.id.desc() if descending else obj.id)
+    if descending:
+        return q.order_by(sortby.desc(), obj.id.desc())
+    return q.order_by(sortby, obj.id)
+
+
+def _sort(obj, sortby, sortable, sort):
+    """Returns the (column, descending) tuple that the results of a list request are sorted by.
+    sort: The sort query string parameter, which names one of the sortable columns of obj,
+          optionally prefixed with - to sort in descending order. Results are sorted by sortby
+          if it is not specified."""
+    if sort == None:
+        return (sortby, False)
+    descending = sort.startswith('-')
+    name = sort[1:] if descending else sort
+    for column in [sortby] + sortable:
+        if column.key == name:
+            return (column, descending)
+    raise cherrypy.HTTPError(400, 'Invalid sort specified: %s. %s can be sorted by %s.'
+                             % (sort, str(obj), ', '.join(column.key for column in [sortby] + sortable)))
+
+
+def _query(obj, sortby, params, ignored=[], options=[], limit=None):
+    """Performs a generic database query and returns the results as a dictionary.
+    obj: The musik.db object to query (Track, Artist, Album, etc)
+    sortby: The field of obj to sort the results by (Track.title, Artist.name, etc)
+    params: A list of key/value pairs to query with, where key is the database obj
+            field and value is the value to search for. Strings will be matched with
+            a LIKE clause, other values are matched with strict equality.
+    ignored: Fields of obj to leave out of the results
+    options: Loader options that eagerly load the relationships that the results include
+    limit: The maximum number of results to return
+    """
+    q = _order(_filter(obj, params).options(*options), obj, sortby)
+    if limit != None:
+        q = q.limit(limit)
+
     # return the results as JSON
     results = []
-    for a in q.order_by(sortby).all():
+    for a in q.all():
         results.append(a.as_dict(ignored))
 
     return results
 
 
+def _stream(obj, sortby, params, kwargs, ignored=[], options=[], not_found=None, sortable=[]):
+    """Performs a query like _query, but returns a generator that serializes the results to a
+    JSON list as they are read from the database. Handlers that return it must enable
+    response.stream.
+    kwargs: The query string of the request, which may contain
+            limit: The maximum number of results to return. All results are returned
+                   if it is not specified.
+            after: The cursor of the page to return. The first page is returned if it
+                   is not specified.
+            sort: The column to sort the results by instead of sortby. See _sort
+    not_found: If specified, a 404 with this message is raised when nothing matches params.
+    sortable: The other columns of obj that the results can be sorted by. Each of them should
+              be indexed.
+    Sets the X-Total-Count header to the number of results across all pages and, if there
+    are more results, the X-Next-Cursor header to the cursor of the next page.
+    """
+    for key in kwargs:
+        if key not in ['limit', 'after', 'sort']:
+            raise cherrypy.HTTPError(400, 'Invalid query string specified. Unknown parameter %s.' % key)
+    (sortby, descending) = _sort(obj, sortby, sortable, kwargs.get('sort'))
+
+    limit = None
+    if 'limit' in kwargs:
+        try:
+            limit = int(kwargs['limit'])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise cherrypy.HTTPError(400, 'Invalid limit specified: %s' % kwargs['limit'])
+
+    # everything that can fail with an HTTP error has to happen before the response starts
+    q = _filter(obj, params)
+    total = q.count()
+    if total == 0 and not_found != None:
+        raise cherrypy.HTTPError(404, not_found)
+    cherrypy.response.headers['X-Total-Count'] = str(total)
+
+    if 'after' in kwargs:
+        (sort_value, id) = _decode_cursor(kwargs['after'])
+        q = _after(q, obj, sortby, sort_value, id, descending)
+    q = _order(q, obj, sortby, descending)
+
+    if limit != None:
+        # look up the last row of this page and whether another row follows it, without
+        # loading either of them
+        keys = q.with_entities(sortby, obj.id).offset(limit - 1).limit(2).all()
+        if len(keys) == 2:
+            cherrypy.response.headers['X-Next-Cursor'] = _encode_cursor(*keys[0])
+
+    return _iterencode(q.options(*options), obj, sortby, descending, ignored, limit)
+
+
+def _iterencode(q, obj, sortby, descending, ignored, limit):
+    """Generator that yields the results of q as a JSON list, STREAM_BATCH_SIZE rows at a time.
+    Each batch is read with its own keyset query and dropped from the session once it has been
+    serialized, so memory use doesn't grow with the number of results.
+    The request's session is closed before a streaming response is written, so the results are
+    read with a session of their own."""
+    session = DatabaseWrapper().get_session()
+    encoder = DateTimeEncoder()
+    q = q.with_session(session)
+    try:
+        separator = ''
+        count = 0
+        last = None
+        yield '['
+        while limit == None or count < limit:
+            batch_size = STREAM_BATCH_SIZE if limit == None else min(STREAM_BATCH_SIZE, limit - count)
+            batch = (q if last == None else _after(q, obj, sortby, last[0], last[1], descending)).limit(batch_size).all()
+            if len(batch) == 0:
+                break
+
+            chunks = []
+            for row in batch:
+                chunks.append(''.join(encoder.iterencode(row.as_dict(ignored))))
+            yield separator + ', '.join(chunks)
+
+            separator = ', '
+            count += len(batch)
+            last = _cursor_key(batch[-1], sortby)
+            session.expunge_all()
+            if len(batch) < batch_size:
+                break
+        yield ']'
+    finally:
+        session.close()
+
+
+def _summarize(track):
+    """Returns a representation of the track that includes the name of its artist and the title
+    of its album, but not the rest of the album. Used for lists of tracks from all over the
+    library, where the full album of every track would be a waste."""
+    result = track.as_dict(ignored=['album', 'album_artist', 'artist', 'disc'])
+    if track.artist != None:
+        result['artist'] = track.artist.as_dict(ignored=['albums', 'numAlbums', 'numTracks'])
+    if track.album != None:
+        result['album'] = track.album.as_dict(ignored=['artist', 'discs', 'numTracks', 'tracks'])
+    return result
+
+
+def _load_tracks(ids, options):
+    """Returns the tracks with the specified ids, in the same order as the ids"""
+    if len(ids) == 0:
+        return []
+    tracks = cherrypy.request.db.query(Track).filter(Track.id.in_(ids)).options(*options).all()
+    tracks = dict((track.id, track) for track in tracks)
+    return [tracks[id] for id in ids if id in tracks]
+
+
+def _track_filters(kwargs):
+    """Returns the conditions that select the tracks that random and shuffle requests choose
+    from. kwargs may contain genre, artist_id and album_id."""
+    conditions = []
+    if 'genre' in kwargs:
+        conditions.append(Track.genre == kwargs['genre'])
+    for (key, column) in [('artist_id', Track.artist_id), ('album_id', Track.album_id)]:
+        if key in kwargs:
+            try:
+                conditions.append(column == int(kwargs[key]))
+            except ValueError:
+                raise cherrypy.HTTPError(400, 'Invalid %s specified: %s' % (key, kwargs[key]))
+    return conditions
+
+
+def _present():
+    """Returns the condition that excludes tracks whose files have gone missing"""
+    return or_(Track.missing == None, Track.missing == False)
+
+
+def _random_ids(conditions, count):
+    """Returns the ids of up to count distinct tracks that satisfy conditions, chosen at random.
+    - Without conditions, each pick is a random id between the lowest and highest ids followed
+      by a seek to the first track at or after it, so the tracks table is never read in full.
+      The ids of the library are dense, so the tracks that follow the few gaps in them are only
+      a little more likely to be picked than the others.
+    - The tracks of a genre, artist or album can be spread thinly over the whole range of ids,
+      where that approach would nearly always pick the track after the biggest gap. Instead,
+      the ids of the matching tracks are read from the index on the filtered column, which
+      holds them without the rows having to be read, and the picks are sampled from them.
+    """
+    db = cherrypy.request.db
+    if len(conditions) == 0:
+        q = db.query(Track.id, Track.missing).order_by(Track.id)
+        (low, high) = db.query(func.min(Track.id), func.max(Track.id)).one()
+        if low == None:
+            return []
+
+        ids = []
+        for attempt in range(count * 4):
+            row = q.filter(Track.id >= random.randint(low, high)).first()
+            if row != None and not row.missing and row.id not in ids:
+                ids.append(row.id)
+                if len(ids) == count:
+                    return ids
+
+        # so many picks collided that there can only be a few tracks. Choose among all of them.
+        ids = [row.id for row in q.filter(_present())]
+        return random.sample(ids, min(count, len(ids)))
+
+    # plain rows from the statement are much cheaper than the ORM's named tuples
+    candidates = [row[0] for row in db.execute(db.query(Track.id).filter(*conditions).statement)]
+    ids = []
+    while len(candidates) > 0 and len(ids) < count:
+        picks = random.sample(candidates, min(count - len(ids), len(candidates)))
+        # whether a file has gone missing isn't in the index, so it is only checked for the picks
+        present = set(row.id for row in db.query(Track.id).filter(Track.id.in_(picks), _present()))
+        ids.extend(i for i in picks if i in present)
+        if len(ids) < count:
+            picked = set(picks)
+            candidates = [i for i in candidates if i not in picked]
+    return ids
+
+
+class ShuffleCache(object):
+    """The shuffled orders of the tracks that match each set of filters, keyed on the filters
+    and the seed that shuffled them. The same seed and filters always produce the same order,
+    so clients can page through a shuffle queue one request at a time.
+    An order is rebuilt once the library generation that it was built from is no longer current.
+    """
+    size = 0            # maximum number of orders
+    entries = None      # LRUCache of (generation, ids) tuples keyed on (filters, seed)
+    lock = None         # requests are served by several threads at once
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = LRUCache(size)
+        self.lock = threading.Lock()
+
+    def get(self, filters, conditions, seed):
+        """Returns an array of the ids of the tracks that satisfy conditions, shuffled by seed"""
+        (generation, modified) = library_generation.current()
+        key = (filters, seed)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] == generation:
+                return entry[1]
+
+        # ids are loaded in a fixed order so that the seed alone decides the shuffled order. Plain
+        # rows from the statement are about ten times cheaper than the ORM's named tuples.
+        q = cherrypy.request.db.query(Track.id).filter(*conditions).filter(_present()).order_by(Track.id)
+        ids = array('l', (row[0] for row in cherrypy.request.db.execute(q.statement)))
+        random.Random(seed).shuffle(ids)
+
+        with self.lock:
+            self.entries.put(key, (generation, ids))
+        return ids
+
+
+shuffle_cache = ShuffleCache(SHUFFLE_CACHE_SIZE)
+
+
 class Album():
     log = None
     exposed = True
@@ -55,6 +422,7 @@ class Album():
     def __init__(self):
         self.log = log.Log(__name__)
 
+    @cached
     def GET(self, *params):
         """Assembles an album query by appending query parameters as filters.
         The result is a query that satisfies all of the parameters that were
@@ -65,7 +433,7 @@ class Album():
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
         # return everything that we know about the first album in the list
-        results = _query(obj=musik.db.Album, sortby=musik.db.Album.title_sort, params=params, ignored=[])
+        results = _query(obj=musik.db.Album, sortby=musik.db.Album.title_sort, params=params, options=ALBUM_OPTIONS, limit=1)
         if len(results) == 0:
             raise cherrypy.HTTPError(404, 'Album not found')
         return json.dumps(results[0], cls=DateTimeEncoder)
@@ -78,21 +446,24 @@ class Albums():
     def __init__(self):
         self.log = log.Log(__name__)
 
-    def GET(self, *params):
+    @cached
+    def GET(self, *params, **kwargs):
         """Assembles an album query by appending query parameters as filters.
         The result is a query that satisfies all of the parameters that were
         passed on the url string.
         Returns the results of the query sorted by title_sort property
+        The limit and after query string parameters select a single page of results.
+        The sort query string parameter sorts by track_count or length instead, e.g. sort=-length
         """
 
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
         # return the list of albums, but don't expand each track in each album. the client can call
         # the Album endpoint to get those details if necessary
-        results = _query(obj=musik.db.Album, sortby=musik.db.Album.title_sort, params=params, ignored=['tracks'])
-        if len(results) == 0:
-            raise cherrypy.HTTPError(404, 'Albums not found')
-        return json.dumps(results, cls=DateTimeEncoder)
+        return _stream(obj=musik.db.Album, sortby=musik.db.Album.title_sort, params=params, kwargs=kwargs, ignored=['tracks'], options=ALBUMS_OPTIONS, not_found='Albums not found',
+                       sortable=[musik.db.Album.track_count, musik.db.Album.length])
+
+    GET._cp_config = {'response.stream': True}
 
 
 class Artist():
@@ -102,6 +473,7 @@ class Artist():
     def __init__(self):
         self.log = log.Log(__name__)
 
+    @cached
     def GET(self, *params):
         """Assembles an artist query by appending query parameters as filters.
         The result is a query that satisfies all of the parameters that were
@@ -112,7 +484,7 @@ class Artist():
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
         # return everything that we know about the first artist in the list
-        results = _query(obj=musik.db.Artist, sortby=musik.db.Artist.name_sort, params=params, ignored=[])
+        results = _query(obj=musik.db.Artist, sortby=musik.db.Artist.name_sort, params=params, options=ARTIST_OPTIONS, limit=1)
         if len(results) == 0:
             raise cherrypy.HTTPError(404, 'Artist not found')
         return json.dumps(results[0], cls=DateTimeEncoder)
@@ -125,21 +497,25 @@ class Artists():
     def __init__(self):
         self.log = log.Log(__name__)
 
-    def GET(self, *params):
+    @cached
+    def GET(self, *params, **kwargs):
         """Assembles an artist query by appending query parameters as filters.
         The result is a query that satisfies all of the parameters that were
         passed on the url string.
         Returns the results of the query sorted by name_sort property
+        The limit and after query string parameters select a single page of results.
+        The sort query string parameter sorts by album_count, track_count or length instead,
+        e.g. sort=-track_count
         """
 
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
         # return the list of artists, but don't expand on each album in the list. the client can call
         # the Artist endpoint to get those details if necessary.
-        results = _query(obj=musik.db.Artist, sortby=musik.db.Artist.name_sort, params=params, ignored=['albums'])
-        if len(results) == 0:
-            raise cherrypy.HTTPError(404, 'Artists not found')
-        return json.dumps(results, cls=DateTimeEncoder)
+        return _stream(obj=musik.db.Artist, sortby=musik.db.Artist.name_sort, params=params, kwargs=kwargs, ignored=['albums'], options=ARTISTS_OPTIONS, not_found='Artists not found',
+                       sortable=[musik.db.Artist.album_count, musik.db.Artist.track_count, musik.db.Artist.length])
+
+    GET._cp_config = {'response.stream': True}
 
 
 class Discs():
@@ -149,19 +525,22 @@ class Discs():
     def __init__(self):
         self.log = log.Log(__name__)
 
-    def GET(self, *params):
+    @cached
+    def GET(self, *params, **kwargs):
         """Assembles an disc query by appending query parameters as filters.
         The result is a query that satisfies all of the parameters that were
         passed on the url string.
         Returns the results of the query sorted by id property
+        The limit and after query string parameters select a single page of results.
         TODO: sort by album
         """
 
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
         # do the query
-        results = _query(Disc, Disc.id, params)
-        return json.dumps(results, cls=DateTimeEncoder)
+        return _stream(Disc, Disc.id, params, kwargs, options=DISCS_OPTIONS)
+
+    GET._cp_config = {'response.stream': True}
 
 
 class Tracks():
@@ -171,29 +550,107 @@ class Tracks():
     def __init__(self):
         self.log = log.Log(__name__)
 
-    def GET(self, *params):
+    def GET(self, *params, **kwargs):
         """Assembles an track query by appending query parameters as filters.
         The result is a query that satisfies all of the parameters that were
         passed on the url string.
         Returns the results of the query sorted by title_sort property
+        The limit and after query string parameters select a single page of results.
+        /tracks/random and /tracks/shuffle are handled by random_tracks and shuffle.
         """
         cherrypy.response.headers['Content-Type'] = 'application/json'
 
-        # catch random track requests
+        # catch random track and shuffle requests
         if len(params) == 1 and params[0] == 'random':
-            return self.random_track()
+            return self.random_tracks(**kwargs)
+        if len(params) == 1 and params[0] == 'shuffle':
+            return self.shuffle(**kwargs)
 
-        # do the query
-        results = _query(Track, Track.title, params)
-        return json.dumps(results, cls=DateTimeEncoder)
+        # random tracks and shuffle queues are different every time, so only lists of tracks are cached
+        return response_cache.serve(lambda: _stream(Track, Track.title, params, kwargs, options=TRACKS_OPTIONS))
 
-    def random_track(self):
-        """Returns a random track from the library."""
+    GET._cp_config = {'response.stream': True}
+
+    def random_tracks(self, n=None, **kwargs):
+        """Returns a random track from the library, or a list of n distinct random tracks if n
+        is specified. The tracks can be restricted to a genre, artist_id or album_id."""
 
         cherrypy.response.headers['Content-Type'] = 'application/json'
         self.log.info(u'RandomTracks called.')
 
-        q = cherrypy.request.db.query(Track).all()
-        track = q[random.randint(0, len(q) - 1)]
+        for key in kwargs:
+            if key not in ['genre', 'artist_id', 'album_id']:
+                raise cherrypy.HTTPError(400, 'Invalid query string specified. Unknown parameter %s.' % key)
+
+        try:
+            count = 1 if n == None else int(n)
+        except ValueError:
+            count = 0
+        if count < 1 or count > RANDOM_MAX_COUNT:
+            raise cherrypy.HTTPError(400, 'Invalid number of tracks specified: %s' % n)
+
+        tracks = _load_tracks(_random_ids(_track_filters(kwargs), count), TRACKS_OPTIONS)
+        if n == None:
+            if len(tracks) == 0:
+                raise cherrypy.HTTPError(404, 'Track not found')
+            return json.dumps(tracks[0].as_dict(), cls=DateTimeEncoder)
+        return json.dumps([track.as_dict() for track in tracks], cls=DateTimeEncoder)
+
+    def shuffle(self, seed=None, offset=0, limit=SHUFFLE_DEFAULT_LIMIT, **kwargs):
+        """Returns a page of a shuffled queue of every track in the library, or of the tracks of
+        a genre, artist_id or album_id.
+        The first request should leave out seed. The response's X-Shuffle-Seed header holds the
+        seed of the new queue, which later requests pass back along with the offset of the page
+        that they want. Requests with the same seed and filters see the same order as long as
+        the library doesn't change. X-Total-Count holds the length of the queue."""
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+
+        for key in kwargs:
+            if key not in ['genre', 'artist_id', 'album_id']:
+                raise cherrypy.HTTPError(400, 'Invalid query string specified. Unknown parameter %s.' % key)
+
+        try:
+            seed = random.getrandbits(32) if seed == None else int(seed)
+            offset = int(offset)
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid seed, offset or limit specified')
+        if offset < 0 or limit < 1:
+            raise cherrypy.HTTPError(400, 'Invalid offset or limit specified')
 
-        return json.dumps(track.as_dict(), cls=DateTimeEncoder)
+        ids = shuffle_cache.get(tuple(sorted(kwargs.items())), _track_filters(kwargs), seed)
+        cherrypy.response.headers['X-Shuffle-Seed'] = str(seed)
+        cherrypy.response.headers['X-Total-Count'] = str(len(ids))
+
+        tracks = _load_tracks(list(ids[offset:offset + limit]), SEARCH_OPTIONS)
+        return json.dumps([_summarize(track) for track in tracks], cls=DateTimeEncoder)
+
+
+class Search():
+    log = None
+    exposed = True
+
+    def __init__(self):
+        self.log = log.Log(__name__)
+
+    @cached
+    def GET(self, q='', limit=None):
+        """Searches the titles, artists, albums, genres and lyrics of the tracks in the library.
+        q: The words to search for. Each word matches any word that it is a prefix of.
+        limit: The maximum number of results to return
+        Returns the matching tracks, best match first. Each result includes the name of its
+        artist and the title of its album, but not the rest of the album.
+        """
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+
+        try:
+            count = SEARCH_DEFAULT_LIMIT if limit == None else int(limit)
+        except ValueError:
+            count = 0
+        if count < 1 or count > SEARCH_MAX_LIMIT:
+            raise cherrypy.HTTPError(400, 'Invalid limit specified: %s' % limit)
+
+        ids = search.search(cherrypy.request.db.connection(), q, count)
+        results = [_summarize(track) for track in _load_tracks(ids, SEARCH_OPTIONS) if not track.missing]
+        return json.dumps(results, cls=DateTimeEncoder)
@@ -1,8 +1,11 @@
 from musik import log
 from musik import audiotranscode
 from musik import db
+from musik.audiotranscode.scheduler import SchedulerBusy
+from musik.transcoding import bitrate_policy, transcode_cache, transcode_scheduler, transcoder
 
 import cherrypy
+from cherrypy.lib import cptools, httputil, static
 import json
 import os
 
@@ -13,10 +16,9 @@ class DecoderEnumerator():
 
 	def GET(self):
 		"""Returns an array of audio mime types that the server can decode audio files from"""
-		transcode = audiotranscode.AudioTranscode()
 		mimetypes = []
-		for dec in transcode.Decoders:
-			if dec.available():
+		for dec in transcoder.available_decoders:
+			if audiotranscode.MIMETYPES[dec.filetype] not in mimetypes:
 				mimetypes.append(audiotranscode.MIMETYPES[dec.filetype])
 		return json.dumps(mimetypes)
 
@@ -27,39 +29,77 @@ class EncoderEnumerator():
 
 	def GET(self):
 		"""Returns an array of audio mime types that the server can encode audio files to"""
-		transcode = audiotranscode.AudioTranscode()
 		mimetypes = []
-		for enc in transcode.Encoders:
-			if enc.available():
+		for enc in transcoder.available_encoders:
+			if audiotranscode.MIMETYPES[enc.filetype] not in mimetypes:
 				mimetypes.append(audiotranscode.MIMETYPES[enc.filetype])
 		return json.dumps(mimetypes)
 
 
+class Capabilities():
+	"""Functions for inspecting and refreshing the encoders and decoders that the server found.
+	The PATH is searched for their commands once, when they are first needed, and the absolute
+	paths are reused for every stream after that."""
+	exposed=True
+
+	def GET(self):
+		"""Returns the available encoders and decoders in the order that they are tried, with the
+		format that each handles and the command that it runs. In-process ones have no path."""
+		cherrypy.response.headers['Content-Type'] = 'application/json'
+		def describe(transcoders):
+			return [{'format': t.filetype, 'command': t.command[0], 'path': t.path} for t in transcoders]
+		return json.dumps({
+			'encoders': describe(transcoder.available_encoders),
+			'decoders': describe(transcoder.available_decoders),
+		})
+
+	def POST(self):
+		"""Searches the PATH for every encoder and decoder again, e.g. after one was installed
+		or removed, and returns the result like GET"""
+		audiotranscode.refresh()
+		return self.GET()
+
+
+class SchedulerStatus():
+	"""Functions for monitoring the transcode scheduler"""
+	exposed=True
+
+	def GET(self):
+		"""Returns the number of transcodes that are running and waiting to start, how many have
+		been started and turned away, and how many seconds they have waited for a free pipeline"""
+		cherrypy.response.headers['Content-Type'] = 'application/json'
+		return json.dumps(transcode_scheduler.stats())
+
+
 class Track():
 	"""Functions for streaming single audio tracks"""
 	exposed = True
 	decoders = DecoderEnumerator()
 	encoders = EncoderEnumerator()
+	capabilities = Capabilities()
+	scheduler = SchedulerStatus()
 	log = None
 
 	def __init__(self):
 		self.log = log.Log(__name__)
 
 
-	def transcodeStream(self, uri, mimetype, targetFormat, targetMimeType):
+	def transcodeStream(self, uri, mimetype, targetFormat, targetMimeType, bitrate, cachePath, slot):
 		"""Reads the file at the specified uri, transcodes it into the targetFormat (a short-hand
 		version of targetMimeType), and yields the data out as it's ready.
 		* uri: The uri of the file to transcode.
 		* mimetype: the mime type of the file. Used for logging.
 		* targetFormat: the target format. One of mp3, ogg, flac, aac, m4a, or wav.
 		* targetMimeType: the target mime type. Must match targetFormat. Used for logging.
+		* bitrate: the bitrate to encode at, in kbps.
+		* cachePath: where the transcode cache keeps the output once the stream is complete.
+		* slot: the transcode scheduler slot that the stream runs in. It is released when the stream ends.
 		NOTE: this function silently eats exceptions, which will just cause the
 		audio stream to end, and the client player to choke. Ideally, we would notify
 		the user of the error as well.
 		"""
 		try:
-			transcode = audiotranscode.AudioTranscode()
-			for data in transcode.transcode_stream(uri, targetFormat):
+			for data in transcode_cache.record(cachePath, transcoder.transcode_stream(uri, targetFormat, bitrate)):
 				yield data
 
 		except audiotranscode.TranscodeError as e:
@@ -69,20 +109,72 @@ class Track():
 		except audiotranscode.DecodeError as e:
 			self.log.error(u'Missing decoder for %s' % mimetype)
 		finally:
+			slot.release()
 			self.log.info(u'Streaming is complete. Closing stream.')
 
 
-	def GET(self, id, accept=None):
+	def serveFile(self, uri, mimetype):
+		"""Sends the file at the specified uri to the client as it is.
+		Clients can seek by requesting byte ranges instead of downloading the whole file again.
+		A single range gets a 206 Partial Content response, and several ranges get a
+		multipart/byteranges response. The ETag and Last-Modified headers identify the version
+		of the file, so If-Range, If-None-Match and If-Modified-Since requests get the right
+		answer after the file changes.
+		"""
+		path = os.path.abspath(uri)
+		try:
+			st = os.stat(path)
+		except OSError:
+			raise cherrypy.HTTPError(404, 'The file for this track is missing')
+
+		etag = '"%x-%x"' % (st.st_size, int(st.st_mtime * 1000))
+		cherrypy.response.headers['ETag'] = etag
+		cptools.validate_etags()
+
+		# a range of an older version of the file would be garbage, so the whole file is sent instead
+		condition = cherrypy.request.headers.get('If-Range')
+		if condition != None and condition not in [etag, httputil.HTTPDate(st.st_mtime)]:
+			cherrypy.request.headers.pop('Range', None)
+
+		# serve_file also sets Last-Modified, Accept-Ranges and Content-Length. It needs a native
+		# string for the content type of multipart responses.
+		return static.serve_file(path, None if mimetype == None else str(mimetype))
+
+
+	def requestedBitrate(self, targetFormat, bitrate, quality):
+		"""Returns the bitrate in kbps that a stream in the targetFormat was asked for at, either
+		as a number of kbps or as one of the audiotranscode.QUALITIES, rounded down to one of the
+		audiotranscode.BITRATE_STEPS. Lossless formats always get their default bitrate."""
+		if targetFormat in audiotranscode.LOSSLESS or (bitrate == None and quality == None):
+			return audiotranscode.default_bitrate(targetFormat)
+		if bitrate != None:
+			try:
+				return audiotranscode.bitrate_step(int(bitrate))
+			except ValueError:
+				raise cherrypy.HTTPError(400, 'The bitrate must be a number of kbps')
+		if quality not in audiotranscode.QUALITIES:
+			raise cherrypy.HTTPError(400, 'The quality must be one of %s' % ', '.join(sorted(audiotranscode.QUALITIES)))
+		return audiotranscode.QUALITIES[quality]
+
+
+	def GET(self, id, accept=None, bitrate=None, quality=None):
 		"""Transcodes the track with the specified unique id to the specified accept type and
 		streams it to the client. 
 		* id: the unique identifier of a track in the database
 		* accept: the target format. One of mp3, ogg, flac, aac, m4a, or wav. 
+		* bitrate: the bitrate to transcode at, in kbps. Optional, and ignored for lossless formats.
+		* quality: low, medium or high, in place of a bitrate. Optional.
 		If accept is undefined or matches the native type of the file, no transcoding will take place.
 		Streaming begins immediately, even if the entire file has not yet been transcoded.
+		The bitrate that the stream is actually encoded at is returned in the X-Bitrate header. It
+		can be lower than the one that was asked for if the server is busy or the client's
+		connection is slow.
 		"""
 
 		# look up the track in the database
 		track = cherrypy.request.db.query(db.Track).filter(db.Track.id == id).first()
+		if track == None:
+			raise cherrypy.HTTPError(404, 'Track not found')
 		uri = track.uri
 
 		targetFormat = None
@@ -101,16 +193,52 @@ class Track():
 
 		# if accept wasn't specified or matches original encoding, no need to transcode
 		if accept == None or targetMimeType == track.mimetype:
-			sizeInBytes = os.path.getsize(uri)
-			cherrypy.response.headers['Content-Length'] = sizeInBytes
-			cherrypy.response.headers['Content-Type'] = track.mimetype
 			self.log.info(u'Started streaming %s without transcoding' % unicode(uri))
-			return open(uri, 'rb')
+			return self.serveFile(uri, track.mimetype)
 
-		# otherwise, go ahead and transcode into the desired format
-		# in this case, we can't set a content-length header, so player has to get length elsewhere
+		client = cherrypy.request.remote.ip
+		bitrate = bitrate_policy.for_client(client, targetFormat, self.requestedBitrate(targetFormat, bitrate, quality))
+		try:
+			mtime = os.path.getmtime(uri)
+		except OSError:
+			raise cherrypy.HTTPError(404, 'The file for this track is missing')
+
+		# tracks that have been transcoded before are sent from the cache, just like untranscoded
+		# files. While the server is busy, a lower bitrate that is already cached will also do, and
+		# if neither is cached, the lower one is transcoded.
+		loadBitrate = bitrate_policy.for_load(targetFormat, bitrate)
+		for candidate in sorted(set([bitrate, loadBitrate]), reverse=True):
+			cachePath = transcode_cache.path(track.id, mtime, targetFormat, candidate)
+			if transcode_cache.get(cachePath):
+				self.log.info(u'Started streaming %s as %s at %dkbps from the transcode cache' % (unicode(uri), targetMimeType, candidate))
+				cherrypy.response.headers['X-Bitrate'] = str(candidate)
+				return self.serveFile(cachePath, targetMimeType)
+
+		bitrate = loadBitrate
+		cachePath = transcode_cache.path(track.id, mtime, targetFormat, bitrate)
+
+		# otherwise, wait for a free pipeline. If there isn't going to be one soon, the client is
+		# told to come back later rather than starting yet another pair of processes.
+		try:
+			slot = transcode_scheduler.acquire(client)
+		except SchedulerBusy as e:
+			self.log.info(u'Turned away a request to stream %s as %s: %s' % (unicode(uri), targetMimeType, e.value))
+			# HTTPError would strip the Retry-After header from the response
+			cherrypy.response.status = 503
+			cherrypy.response.headers['Content-Type'] = 'text/plain'
+			cherrypy.response.headers['Retry-After'] = str(e.retry_after)
+			return 'The server is too busy to transcode this track right now'
+
+		# a stream that is abandoned before it starts never runs its own cleanup
+		cherrypy.request.hooks.attach('on_end_request', slot.release)
+
+		# go ahead and transcode into the desired format
+		# in this case, we can't set a content-length header, so player has to get length elsewhere.
+		# Nor can the client seek, because the output isn't known until it has been produced.
 		cherrypy.response.headers['Content-Type'] = targetMimeType
-		self.log.info(u'Started streaming %s as %s' % (unicode(uri), targetMimeType))
-		return self.transcodeStream(uri, track.mimetype, targetFormat, targetMimeType)
+		cherrypy.response.headers['Accept-Ranges'] = 'none'
+		cherrypy.response.headers['X-Bitrate'] = str(bitrate)
+		self.log.info(u'Started streaming %s as %s at %dkbps' % (unicode(uri), targetMimeType, bitrate))
+		return bitrate_policy.measure(client, self.transcodeStream(uri, track.mimetype, targetFormat, targetMimeType, bitrate, cachePath, slot))
 
 	GET._cp_config = {'response.stream': True}
\ No newline at end of file
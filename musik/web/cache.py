@@ -0,0 +1,138 @@
+import functools
+import threading
+
+import cherrypy
+from cherrypy.lib import cptools, httputil
+
+from musik import config
+from musik.db import library_generation
+from musik.util import LRUCache
+
+
+# the headers that are stored and replayed along with each cached response body
+CACHED_HEADERS = ['Content-Type', 'X-Next-Cursor', 'X-Total-Count']
+
+
+class ResponseCache(object):
+    """A least-recently-used cache of the bodies of library API responses, limited to a
+    number of bytes.
+    The library only changes when the importer commits, so a response is reused until the
+    library generation that it was built from is no longer current. Every response also
+    carries an ETag and a Last-Modified header that describe the generation, so a client
+    that already has the current response gets a 304 Not Modified without the library
+    being queried at all.
+    """
+    max_size = 0        # maximum total size of the cached bodies, in bytes
+    max_entry_size = 0  # responses that are bigger than this are never cached
+    generation = 0      # the library generation of every entry in the cache
+    entries = None      # LRUCache of (headers, body) tuples keyed on request, weighed by the size of the body
+    hits = 0            # number of responses that were served from the cache
+    misses = 0          # number of responses that had to be built
+    lock = None         # requests are served by several threads at once
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # a single response shouldn't be able to push most of the others out
+        self.max_entry_size = max_size // 4
+        self.entries = LRUCache(max_size, lambda entry: len(entry[1]))
+        self.lock = threading.Lock()
+
+    def serve(self, build):
+        """Returns the response to the current request, calling build to create it if it isn't
+        in the cache. build returns the response body, either as a string or as an iterable of
+        strings for streamed responses, and may set any of the CACHED_HEADERS.
+        Raises a 304 redirect if the client's copy of the response is still current."""
+        if self.max_size <= 0:
+            # the cache is turned off
+            return build()
+
+        (generation, modified) = library_generation.current()
+        response = cherrypy.response
+        response.headers['ETag'] = '"%x-%x"' % (library_generation.started, generation)
+        response.headers['Last-Modified'] = httputil.HTTPDate(modified)
+
+        # the client has to check back every time because the library can change at any moment
+        response.headers['Cache-Control'] = 'private, no-cache'
+        cptools.validate_etags()
+        if 'If-None-Match' not in cherrypy.request.headers:
+            cptools.validate_since()
+
+        key = (cherrypy.request.path_info, cherrypy.request.query_string)
+        entry = self.get(key, generation)
+        if entry != None:
+            (headers, body) = entry
+            response.headers.update(headers)
+            return body
+
+        try:
+            body = build()
+        except:
+            # errors aren't cached and describe no particular generation
+            for name in ['ETag', 'Last-Modified', 'Cache-Control']:
+                response.headers.pop(name, None)
+            raise
+
+        headers = dict((name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers)
+        if isinstance(body, basestring):
+            self.put(key, generation, headers, body)
+            return body
+        return self.record(key, generation, headers, body)
+
+    def record(self, key, generation, headers, chunks):
+        """Yields each of the chunks of a streamed response, and caches the complete body once
+        the last one has been sent, unless it turns out to be too big to cache."""
+        body = []
+        size = 0
+        for chunk in chunks:
+            if body != None:
+                size += len(chunk)
+                if size > self.max_entry_size:
+                    body = None
+                else:
+                    body.append(chunk)
+            yield chunk
+
+        if body != None:
+            self.put(key, generation, headers, ''.join(body))
+
+    def get(self, key, generation):
+        """Returns the (headers, body) tuple that is cached under the specified key for the
+        specified library generation, or None"""
+        with self.lock:
+            entry = self.entries.get(key) if generation == self.generation else None
+            if entry == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, generation, headers, body):
+        """Caches a response that was built from the specified library generation, evicting the
+        least recently used responses until the cache fits within max_size"""
+        if len(body) > self.max_entry_size:
+            return
+        with self.lock:
+            if generation < self.generation:
+                # the library changed while the response was being built
+                return
+            if generation > self.generation:
+                # none of the existing entries can ever be served again
+                self.entries.clear()
+                self.generation = generation
+            self.entries.put(key, (headers, body))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+response_cache = ResponseCache(int(config.get('Cache', 'response_cache_size')) * 1024 * 1024)
+
+
+def cached(handler):
+    """Decorates a page handler so that its responses are served through the response cache.
+    Only handlers whose responses depend on nothing but the request url and the contents of
+    the library can be cached."""
+    @functools.wraps(handler)
+    def serve(*args, **kwargs):
+        return response_cache.serve(lambda: handler(*args, **kwargs))
+    return serve
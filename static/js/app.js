@@ -38,6 +38,21 @@ var artists = null;
  */
 var tracks = null;
 
+/**
+ * The number of artists or albums that are fetched from the server at a time
+ */
+var pageSize = 100;
+
+/**
+ * The pages of albums that have been fetched for the album list so far, in order
+ */
+var albumList = null;
+
+/**
+ * The pages of artists that have been fetched for the artist list so far, in order
+ */
+var artistList = null;
+
 /**
  * Computes a basic authorization header value based on the global user object.
  * If the global user object is not set, displays the login template
@@ -65,25 +80,34 @@ function getEncoderMimeTypes(callback) {
 }
 
 /**
- * Fetches the list of all albums from the server
- * The specified callback function will be called with json object returned by the api on success
+ * Fetches a page of the list of albums from the server
+ * after is the cursor of the page to fetch, or null to fetch the first page
+ * The specified callback function will be called with json object returned by the api and the
+ * cursor of the next page, or null if this is the last page, on success
  */
- function getAlbums(callback) {
+ function getAlbums(after, callback) {
+    var params = {limit: pageSize};
+    if (after != null) {
+        params.after = after;
+    }
 
     $.ajax('http://localhost:8080/api/albums', {
         contentType: 'application/json',
+        data: params,
         headers: {
             Authorization: getBasicAuthHeader()
         },
         type: 'GET'
     })
-    .done(function(data) {
-        albums = {};
+    .done(function(data, textStatus, jqXHR) {
+        if (after == null || albums == null) {
+            albums = {};
+        }
         for(var i = 0; i < data.length; i++) {
             var album = data[i];
             albums[album.id] = album;
         };
-        callback(data);
+        callback(data, jqXHR.getResponseHeader('X-Next-Cursor'));
     })
     .fail(function() {
         console.log('GET request to /api/albums failed');
@@ -117,24 +141,34 @@ function getEncoderMimeTypes(callback) {
 }
 
 /**
- * Fetches the list of all artists from the server
- * The specified callback function will be called with the json object returned by the api on success
+ * Fetches a page of the list of artists from the server
+ * after is the cursor of the page to fetch, or null to fetch the first page
+ * The specified callback function will be called with the json object returned by the api and the
+ * cursor of the next page, or null if this is the last page, on success
  */
- function getArtists(callback) {
+ function getArtists(after, callback) {
+    var params = {limit: pageSize};
+    if (after != null) {
+        params.after = after;
+    }
+
     $.ajax('http://localhost:8080/api/artists', {
         contentType: 'application/json',
+        data: params,
         headers: {
             Authorization: getBasicAuthHeader()
         },
         type: 'GET'
     })
-    .done(function(data) {
-        artists = {};
+    .done(function(data, textStatus, jqXHR) {
+        if (after == null || artists == null) {
+            artists = {};
+        }
         for(var i = 0; i < data.length; i++) {
             var artist = data[i];
             artists[artist.id] = artist;
         };
-        callback(data);
+        callback(data, jqXHR.getResponseHeader('X-Next-Cursor'));
     })
     .fail(function() {
         console.log('GET request to /api/artists failed');
@@ -383,18 +417,40 @@ function logout() {
         'use strict'; 
         event.preventDefault();
 
-        //fetch a list of artists from the api and display them in the template
-        getArtists(function (data) {
-            displayTemplate('#artists-template', data);
+        //fetch the first page of artists from the api and display them in the template
+        getArtists(null, function (data, nextCursor) {
+            artistList = data;
+            displayTemplate('#artists-template', {artists: artistList, nextCursor: nextCursor});
         });
     });
     $('nav.navigation a.albums').on('click.musik.nav', function(event) {
         'use strict'; 
         event.preventDefault();
 
-        //fetch a list of albums from the api and display them in the template
-        getAlbums(function (data) {
-            displayTemplate('#albums-template', data);
+        //fetch the first page of albums from the api and display them in the template
+        getAlbums(null, function (data, nextCursor) {
+            albumList = data;
+            displayTemplate('#albums-template', {albums: albumList, nextCursor: nextCursor});
+        });
+    });
+
+    //load the next page of the artist or album list
+    $('.artists a.more').on('click.musik.nav', function(event) {
+        'use strict';
+        event.preventDefault();
+
+        getArtists($(this).attr('cursor'), function (data, nextCursor) {
+            artistList = artistList.concat(data);
+            displayTemplate('#artists-template', {artists: artistList, nextCursor: nextCursor});
+        });
+    });
+    $('.albums a.more').on('click.musik.nav', function(event) {
+        'use strict';
+        event.preventDefault();
+
+        getAlbums($(this).attr('cursor'), function (data, nextCursor) {
+            albumList = albumList.concat(data);
+            displayTemplate('#albums-template', {albums: albumList, nextCursor: nextCursor});
         });
     });
     $('nav.navigation a.addmedia').on('click.musik.nav', function(event) {